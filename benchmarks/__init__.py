@@ -0,0 +1,2 @@
+# Benchmarks of budget.py hot paths
+# Run from the repository root: python -m benchmarks --sizes 1000 100000 1000000 --output bench.json
@@ -0,0 +1,172 @@
+# Benchmark budget.py hot paths on synthetic bank exports, against an in-memory Sheets fake
+# Usage: python -m benchmarks [--sizes 1000 100000 1000000] [--repeat 3] [--output results.json]
+
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import pandas
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import budget
+from benchmarks.fake_sheets import FakeDrive, FakeSpreadsheet
+from benchmarks.synthetic import generate_exports
+
+# Default number of transactions benchmarked
+SIZES = [1000, 100000, 1000000]
+# Default runs of each benchmark, the fastest one is reported
+REPEAT = 3
+
+def measure(run,setup=None,repeat=REPEAT):
+    """
+    Time a function, keeping the fastest of several runs
+    Args:   run: function to time, given the result of setup
+            setup: untimed function run before each run (optional)
+            repeat: number of runs
+    Return: seconds of fastest run
+    """
+    best = None
+    for _ in range(repeat):
+        state = setup() if setup else None
+        start = time.perf_counter()
+        run(state)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+def fake_session(spreadsheet=None):
+    """
+    Client session on the in-memory fake, without rate limits so only local work is timed
+    Args:   spreadsheet: FakeSpreadsheet to use (optional)
+    Return: SheetsSession
+    """
+    session = budget.SheetsSession(None, sheets=spreadsheet or FakeSpreadsheet(), drive=FakeDrive())
+    session.scheduler.buckets = {bucket: budget.TokenBucket(1e9, 1e9) for bucket in session.scheduler.buckets}
+    return session
+
+def sheet_rows(transactions):
+    """
+    Ledger sheet rows (A:F) of transactions, as read back with unformatted values
+    Args:   transactions: normalized transactions frame
+    Return: list of rows
+    """
+    balances = budget.running_balances(transactions['Cents'].to_numpy())
+    # Some categories set by hand, one per merchant
+    categories = ['Category ' + str(len(description) % 7) for description in transactions['Description']]
+    return [[description, '', int(date), cents / 100, float(balance), category]
+        for (description, date, cents, balance, category)
+        in zip(transactions['Description'], transactions['Date'], transactions['Cents'], balances, categories)]
+
+def bench_csv_to_frame(directory,rows,repeat):
+    # Parse one export of each bank
+    results = []
+    for bank in budget.BANK_FORMATS:
+        (path,) = generate_exports(os.path.join(directory, 'parse'),bank,rows)
+        seconds = measure(lambda state: budget.csv_to_frame(path), repeat=repeat)
+        results.append(('csv_to_frame[' + bank + ']', rows, seconds))
+    return results
+
+def bench_extract_useful_string(directory,rows,repeat):
+    # Normalize raw descriptions one at a time (cold cache) and as one column
+    (path,) = generate_exports(os.path.join(directory, 'normalize'),'PSCU',rows,pending=0)
+    descriptions = budget.csv_to_frame(path)['Description']
+    values = descriptions.tolist()
+    def scalar(state):
+        budget.extract_useful_string.cache_clear()
+        for description in values:
+            budget.extract_useful_string(description)
+    return [
+        ('extract_useful_string', rows, measure(scalar, repeat=repeat)),
+        ('normalize_descriptions', rows, measure(lambda state: budget.normalize_descriptions(descriptions), repeat=repeat)),
+    ]
+
+def bench_compare(directory,rows,repeat):
+    # Deduplicate an export against a ledger holding most of its transactions
+    (path,) = generate_exports(os.path.join(directory, 'compare'),'PSCU',rows,pending=0)
+    transactions = budget.csv_to_frame(path)
+    transactions['Description'] = budget.normalize_descriptions(transactions['Description'])
+    spreadsheet = FakeSpreadsheet()
+    # Last tenth of the export is new
+    spreadsheet.workbook('budget')['Debit'].extend(sheet_rows(transactions.iloc[:rows - rows // 10]))
+    session = fake_session(spreadsheet)
+
+    def compare(mirror):
+        budget.compare_sheet_data_to_csv_data('Debit',transactions,'budget',session,mirror)
+
+    def warm_mirror():
+        mirror = budget.LedgerMirror(':memory:')
+        budget.sync_ledger_mirror('Debit','budget',session,mirror)
+        return mirror
+
+    return [
+        ('compare_sheet_data_to_csv_data[cold]', rows, measure(compare, lambda: budget.LedgerMirror(':memory:'), repeat)),
+        ('compare_sheet_data_to_csv_data[warm]', rows, measure(compare, warm_mirror, repeat)),
+    ]
+
+def bench_categorize(directory,rows,repeat):
+    # Categorize new transactions against categories of a mirrored ledger
+    (path,) = generate_exports(os.path.join(directory, 'categorize'),'CHASE',rows,seed=1)
+    transactions = budget.csv_to_frame(path)
+    transactions['Description'] = budget.normalize_descriptions(transactions['Description'])
+    mirror = budget.LedgerMirror(':memory:')
+    mirror.replace_ledger('budget','Debit',sheet_rows(transactions))
+    # Same merchants, other store numbers and amounts
+    (path,) = generate_exports(os.path.join(directory, 'categorize'),'CHASE',rows,seed=2)
+    new_transactions = budget.csv_to_frame(path)
+    new_transactions['Description'] = budget.normalize_descriptions(new_transactions['Description'])
+    return [('categorize', rows, measure(lambda state: budget.categorize(new_transactions,mirror.category_index), repeat=repeat))]
+
+def bench_ingest(directory,rows,repeat):
+    # Whole run of main(): find exports, parse, deduplicate, categorize, write both ledgers
+    download_dir = os.path.join(directory, 'downloads')
+    # Overlapping PSCU exports (Debit) and a Citi export (Credit)
+    generate_exports(download_dir,'PSCU',rows - rows // 4,files=3)
+    generate_exports(download_dir,'CITI',rows // 4,seed=3)
+
+    def setup():
+        return (fake_session(), budget.LedgerMirror(':memory:'), budget.IngestManifest(':memory:'))
+
+    def run(state):
+        (session, mirror, manifest) = state
+        for (name, spreadsheet_id, result) in budget.ingest(session,mirror,manifest,download_dir):
+            if result.errors:
+                raise RuntimeError(result.errors)
+
+    return [('ingest', rows, measure(run, setup, repeat))]
+
+BENCHMARKS = [bench_csv_to_frame, bench_extract_useful_string, bench_compare, bench_categorize, bench_ingest]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark budget.py on synthetic bank exports')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='number of transactions to benchmark')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='runs of each benchmark, the fastest is reported')
+    parser.add_argument('--output', help='json file to write results to')
+    args = parser.parse_args()
+
+    results = []
+    for rows in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            for benchmark in BENCHMARKS:
+                for (name, count, seconds) in benchmark(directory,rows,args.repeat):
+                    results.append({'benchmark': name, 'rows': count, 'seconds': seconds, 'rows_per_second': count / seconds if seconds else None})
+                    print('{:<42} {:>9} rows {:>10.4f} s {:>14,.0f} rows/s'.format(name, count, seconds, count / seconds if seconds else 0))
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pandas.__version__,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Results written to ' + args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+# In-memory stand-in for the Sheets v4 and Drive v3 services used by budget.py
+# Only the calls budget.py makes are implemented, every call is logged
+
+import re
+
+# Columns of the ledger sheets
+LEDGER_HEADER = ['Description', 'Notes', 'Date', 'Amount', 'Balance', 'Category']
+# Budget spreadsheets listed by the fake drive
+BUDGET_NAMES = [str(year) + ' Budget' for year in range(2015, 2031)]
+
+def http_error(status,message):
+    # googleapiclient HttpError the real api would raise
+    import httplib2
+    from googleapiclient.errors import HttpError
+    return HttpError(httplib2.Response({'status': status}), message.encode('utf-8'))
+
+class FakeRequest:
+    """
+    Request returned by a fake service, run by execute like a googleapiclient HttpRequest
+    Args:   method_id: api method name (i.e. sheets.spreadsheets.values.get)
+            method: http method
+            run: function computing the response
+    """
+    def __init__(self,method_id,method,run):
+        self.methodId = method_id
+        self.method = method
+        self.run = run
+
+    def execute(self,**kwargs):
+        return self.run()
+
+def parse_cell(cell):
+    # A1 cell -> (0 based column, 1 based row or None)
+    match = re.match(r'([A-Z]+)(\d*)$', cell)
+    column = 0
+    for letter in match.group(1):
+        column = column * 26 + ord(letter) - 64
+    return (column - 1, int(match.group(2)) if match.group(2) else None)
+
+def parse_range(a1_range):
+    # A1 range -> (sheet, first column, first row, last column, last row or None)
+    (sheet, cells) = a1_range.split('!')
+    (first, last) = cells.split(':') if ':' in cells else (cells, cells)
+    (first_column, first_row) = parse_cell(first)
+    (last_column, last_row) = parse_cell(last)
+    return (sheet, first_column, first_row or 1, last_column, last_row)
+
+class FakeValues:
+    """
+    spreadsheets().values() of the fake sheets service
+    Args:   spreadsheet: FakeSpreadsheet holding the sheets
+    """
+    def __init__(self,spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def rows(self,spreadsheet_id,a1_range):
+        # Rows of the sheet a range is in, the api rejects ranges of sheets that don't exist
+        workbook = self.spreadsheet.workbook(spreadsheet_id)
+        sheet = a1_range.split('!')[0]
+        if sheet not in workbook:
+            raise http_error(400, 'Unable to parse range: ' + a1_range)
+        return workbook[sheet]
+
+    def read(self,spreadsheet_id,a1_range):
+        (sheet, first_column, first_row, last_column, last_row) = parse_range(a1_range)
+        rows = self.rows(spreadsheet_id, a1_range)[first_row - 1:last_row]
+        values = [list(row[first_column:last_column + 1]) for row in rows]
+        # The api drops trailing empty rows
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def write(self,spreadsheet_id,a1_range,values,major_dimension='ROWS'):
+        (sheet, first_column, first_row, last_column, last_row) = parse_range(a1_range)
+        rows = self.rows(spreadsheet_id, a1_range)
+        if major_dimension == 'COLUMNS':
+            values = [list(row) for row in zip(*values)]
+        for (i, value) in enumerate(values):
+            while len(rows) < first_row + i:
+                rows.append([])
+            row = rows[first_row + i - 1]
+            for (j, cell) in enumerate(value):
+                # The api leaves cells given as None untouched
+                if cell is None:
+                    continue
+                while len(row) <= first_column + j:
+                    row.append('')
+                row[first_column + j] = cell
+        return a1_range
+
+    def get(self,spreadsheetId,range,**kwargs):
+        self.spreadsheet.log('sheets.spreadsheets.values.get', range)
+        def run():
+            values = self.read(spreadsheetId, range)
+            return {'range': range, 'values': values} if values else {'range': range}
+        return FakeRequest('sheets.spreadsheets.values.get', 'GET', run)
+
+    def batchGet(self,spreadsheetId,ranges,**kwargs):
+        self.spreadsheet.log('sheets.spreadsheets.values.batchGet', ranges)
+        return FakeRequest('sheets.spreadsheets.values.batchGet', 'GET',
+            lambda: {'valueRanges': [{'range': a1_range, 'values': self.read(spreadsheetId, a1_range)} for a1_range in ranges]})
+
+    def append(self,spreadsheetId,range,body,**kwargs):
+        self.spreadsheet.log('sheets.spreadsheets.values.append', range)
+        def run():
+            sheet = range.split('!')[0]
+            rows = self.rows(spreadsheetId, range)
+            first_row = len(rows) + 1
+            rows.extend(list(row) for row in body['values'])
+            last_row = first_row + len(body['values']) - 1
+            return {'updates': {'updatedRange': sheet + '!A' + str(first_row) + ':F' + str(last_row)}}
+        return FakeRequest('sheets.spreadsheets.values.append', 'POST', run)
+
+    def batchUpdate(self,spreadsheetId,body):
+        self.spreadsheet.log('sheets.spreadsheets.values.batchUpdate', [data['range'] for data in body['data']])
+        def run():
+            # Nothing is written unless every range is valid
+            for data in body['data']:
+                self.rows(spreadsheetId, data['range'])
+            return {'responses': [{'updatedRange': self.write(spreadsheetId, data['range'], data['values'], data.get('majorDimension', 'ROWS'))} for data in body['data']]}
+        return FakeRequest('sheets.spreadsheets.values.batchUpdate', 'POST', run)
+
+class FakeSpreadsheet:
+    """
+    Fake sheets v4 service, every spreadsheet id starts out with empty Debit/Credit ledgers and no other sheet
+    Args:   None
+    """
+    def __init__(self):
+        # spreadsheet id -> sheet title -> rows
+        self.workbooks = {}
+        # ids of spreadsheets deleted, any request to them fails with 404
+        self.deleted = set()
+        # (method id, range) of every request built
+        self.calls = []
+        self._values = FakeValues(self)
+
+    def workbook(self,spreadsheet_id):
+        if spreadsheet_id in self.deleted:
+            raise http_error(404, 'Requested entity was not found.')
+        if spreadsheet_id not in self.workbooks:
+            self.workbooks[spreadsheet_id] = {'Debit': [list(LEDGER_HEADER)], 'Credit': [list(LEDGER_HEADER)]}
+        return self.workbooks[spreadsheet_id]
+
+    def log(self,method_id,ranges):
+        self.calls.append((method_id, ranges))
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self._values
+
+    def get(self,spreadsheetId,**kwargs):
+        self.log('sheets.spreadsheets.get', None)
+        def run():
+            sheets = [{'properties': {'sheetId': i, 'title': title}} for (i, title) in enumerate(self.workbook(spreadsheetId))]
+            return {'spreadsheetId': spreadsheetId, 'sheets': sheets}
+        return FakeRequest('sheets.spreadsheets.get', 'GET', run)
+
+    def batchUpdate(self,spreadsheetId,body):
+        # Only addSheet requests are supported
+        self.log('sheets.spreadsheets.batchUpdate', None)
+        def run():
+            workbook = self.workbook(spreadsheetId)
+            replies = []
+            for request in body['requests']:
+                title = request['addSheet']['properties']['title']
+                workbook[title] = []
+                replies.append({'addSheet': {'properties': {'sheetId': list(workbook).index(title), 'title': title}}})
+            return {'spreadsheetId': spreadsheetId, 'replies': replies}
+        return FakeRequest('sheets.spreadsheets.batchUpdate', 'POST', run)
+
+class FakeDrive:
+    """
+    Fake drive v3 service listing budget spreadsheets, a page at a time
+    Args:   names: spreadsheet names, the id of each is its name
+    """
+    def __init__(self,names=BUDGET_NAMES):
+        self.names = list(names)
+        self.calls = []
+
+    def files(self):
+        return self
+
+    def list(self,pageSize=100,pageToken=None,**kwargs):
+        self.calls.append(('drive.files.list', pageToken))
+        start = int(pageToken or 0)
+        def run():
+            files = [{'id': name, 'name': name} for name in self.names[start:start + pageSize]]
+            response = {'files': files}
+            if start + pageSize < len(self.names):
+                response['nextPageToken'] = str(start + pageSize)
+            return response
+        return FakeRequest('drive.files.list', 'GET', run)
@@ -0,0 +1,119 @@
+# Synthetic PSCU, Citi and Chase statement exports for benchmarks
+
+import csv
+from datetime import date, timedelta
+import os
+import random
+
+# Raw merchant descriptions as banks export them, {n} is replaced by a random number
+MERCHANTS = [
+    'STARBUCKS STORE {n}',
+    'AMAZON.COM*MK{n} SEATTLE WA',
+    'SHELL OIL {n}',
+    'TARGET T-{n} SAN JOSE CA',
+    'TRADER JOE S #{n}',
+    'CHEVRON {n} MOUNTAIN VIEW',
+    'ZEL *JOHN SMITH {n}',
+    'ACH Debit VENMO PAYMENT CO: VENMO {n}',
+    'BIG 5 SPORTING GOODS {n}',
+    'To Share 00 TRANSFER {n}',
+    'NETFLIX.COM {n}',
+    'COSTCO WHSE #{n}',
+    "MCDONALD'S F{n}",
+    'UBER *TRIP {n}',
+    'PAYROLL DEPOSIT ACME CORP {n}',
+]
+
+# Header of each bank's csv export
+HEADERS = {
+    'PSCU': ['Account Number', 'Post Date', 'Check Number', 'Description', 'Comments', 'Date', 'Amount'],
+    'CITI': ['Status', 'Date', 'Description', 'Debit', 'Credit', 'Member Name'],
+    'CHASE': ['Details', 'Posting Date', 'Description', 'Amount', 'Type', 'Balance', 'Check or Slip #'],
+}
+
+def generate_transactions(rows,start=date(2020, 7, 1),per_day=None,seed=0):
+    """
+    Generate raw transactions in ASC order by date
+    Args:   rows: number of transactions
+            start: date of first transaction
+            per_day: average transactions per day (default spreads rows over about two years)
+            seed: random seed (same seed, same transactions)
+    Return: list of (date, raw description, amount)
+    """
+    per_day = per_day or max(5, rows // 730)
+    rng = random.Random(seed)
+    transactions = []
+    day = start
+    for i in range(rows):
+        # Move to next day every per_day transactions on average
+        if i and rng.random() < 1 / per_day:
+            day += timedelta(days=1)
+        merchant = rng.choice(MERCHANTS).format(n=rng.randint(1, 9999))
+        # Mostly purchases, some deposits
+        if merchant.startswith('PAYROLL') or rng.random() < 0.05:
+            amount = round(rng.uniform(100, 3000), 2)
+        else:
+            amount = -round(rng.uniform(1, 300), 2)
+        transactions.append((day, merchant, amount))
+    return transactions
+
+def write_statement(bank,path,transactions,pending=0):
+    """
+    Write transactions as a bank csv export
+    Args:   bank: PSCU/CITI/CHASE
+            path: csv file to write
+            transactions: list of (date, raw description, amount) in ASC order by date
+            pending: number of pending transactions listed first (PSCU only)
+    Return: path
+    """
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADERS[bank])
+
+        if bank == 'PSCU':
+            last_day = transactions[-1][0] if transactions else date.today()
+            for i in range(pending):
+                writer.writerow(['1234', '', '', 'Pending PURCHASE ' + str(i), '', last_day.strftime('%m/%d/%Y'), '($1.00)'])
+            for (day, description, amount) in transactions:
+                # PSCU lists negative amounts as ($x,xxx.xx)
+                formatted = '${:,.2f}'.format(abs(amount))
+                if amount < 0:
+                    formatted = '(' + formatted + ')'
+                writer.writerow(['1234', day.strftime('%m/%d/%Y'), '', description, 'comment', day.strftime('%m/%d/%Y'), formatted])
+
+        elif bank == 'CITI':
+            # CITI lists transactions in DESC order, charges as positive debits, payments as negative credits
+            for (day, description, amount) in reversed(transactions):
+                (debit, credit) = (-amount, '') if amount < 0 else ('', -amount)
+                writer.writerow(['Cleared', day.strftime('%m/%d/%Y'), description, debit, credit, 'JOHN SMITH'])
+
+        elif bank == 'CHASE':
+            # CHASE lists transactions in DESC order
+            for (day, description, amount) in reversed(transactions):
+                details = 'DEBIT' if amount < 0 else 'CREDIT'
+                writer.writerow([details, day.strftime('%m/%d/%Y'), description, amount, 'DEBIT_CARD', '', ''])
+
+    return path
+
+def generate_exports(directory,bank,rows,files=1,overlap=0.1,pending=5,seed=0):
+    """
+    Write consecutive exports of one account, each overlapping the previous one
+    Args:   directory: folder to write csv files to
+            bank: PSCU/CITI/CHASE
+            rows: total number of distinct transactions
+            files: number of exports
+            overlap: share of each export's transactions also in the previous export
+            pending: pending transactions listed first in each PSCU export
+            seed: random seed
+    Return: list of csv file paths
+    """
+    os.makedirs(directory, exist_ok=True)
+    transactions = generate_transactions(rows,seed=seed)
+    size = -(-rows // files)
+    paths = []
+    for i in range(files):
+        # Start each export a bit before the end of the previous one
+        start = max(0, i * size - int(size * overlap))
+        path = os.path.join(directory, bank.lower() + '_export_' + str(seed) + '_' + str(i) + '.csv')
+        paths.append(write_statement(bank,path,transactions[start:(i + 1) * size],pending))
+    return paths
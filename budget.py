@@ -4,329 +4,1797 @@
 
 #!/usr/local/bin/python3
 
-from datetime import datetime
-from googleapiclient.discovery import build
-from oauth2client.service_account import ServiceAccountCredentials
-from operator import itemgetter
+import argparse
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
+import cProfile
+import csv
+from datetime import date, timedelta
+import functools
+import hashlib
+import importlib.util
+import json
 import os
-import pandas
 from pathlib import Path
 from pprint import pprint
+import random
 import re
-from sortedcontainers import SortedDict
-
-def get_spreadsheet_id(creds):
-    '''
-    Retrieve spreadsheet ID from google drive
-
-    Args: creds=SpecialCredentials
-    Return: spreadsheet ID
-    '''
-    service = build('drive', 'v3', credentials=creds)
-
-    # Call the Drive v3 files.list API
-    results = service.files().list(
-        corpora='user',
-        q="name contains 'Budget'",
-        pageSize=10,
-        spaces='drive', 
-        fields="nextPageToken, files(id, name)").execute()
-    items = results.get('files', [])
-
-    if not items:
-        print('No files found.')
-    else:
-        for item in items:
-            # # TESTING spreadsheet ID
-            # if item['name'] == 'Testing':
-            # REAL BUDGET spreadsheet ID
-            if item['name'] == '2021 Budget':
-                return item['id']
-
-    # The spreadsheet to request.
-    # Real Budget Sheet
-    #spreadsheet_id = '1aakSKaeEc1Mo8cw1MGOrHzZdLvXp8RE4D8c7Ja-R01k'
-    # Test budget sheet
-    #spreadsheet_id = '1yRTLNA43UoU7vrWZEJ9PoK2ZH1AzxkqyBAqL--vuK9Y'
-
-def get_sheet_id(creds,spreadsheet_id,sheet_name):
-    """
-    Retrieve google sheet id (spreadsheet tabs) based on tab name
-    Args:   creds: credentials for account
-            spreadsheet_id: google spreadsheet id
-            sheet_name: sheet title to get id for
-    Return: sheet id for sheet name
+import select
+import sqlite3
+import struct
+import sys
+import threading
+import time
+
+def lazy_import(name):
     """
-    # Define sheets service
-    service = build('sheets', 'v4', credentials=creds)
-    
-    # Attributes to retrieve spreadsheet data
-    ranges = []
-    include_grid_data = False
-
-    # Call spreadsheets.get API
-    request = service.spreadsheets().get(spreadsheetId=spreadsheet_id,ranges=ranges,includeGridData=include_grid_data)
-    response = request.execute()
-
-    # Set current sheet id
-    current_sheet_id = None
-
-    # Search all sheets in tab for matching sheet name
-    for sheet in response['sheets']:
-        if sheet['properties']['title'] == sheet_name:
-            current_sheet_id = sheet['properties']['sheetId']
+    Import a module that is only loaded once one of its attributes is used
+    Args:   name: module name
+    Return: module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+# Heavy modules, loaded by the first stage that needs them (status and runs without new csv files never do)
+# googleapiclient and oauth2client are imported where a session first talks to google
+httplib2 = lazy_import('httplib2')
+numpy = lazy_import('numpy')
+pandas = lazy_import('pandas')
+
+# Directory holding locally cached app state
+APP_DIR = os.path.join(str(Path.home()), '.budget_app')
+# Directory holding cached Google API discovery documents
+DISCOVERY_CACHE_DIR = os.path.join(APP_DIR, 'discovery')
+# Seconds before a cached discovery document is fetched again (1 day)
+DISCOVERY_CACHE_TTL = 24 * 60 * 60
+# Seconds before an idle http request times out
+HTTP_TIMEOUT = 60
+
+# Api calls allowed per minute for each quota bucket (Sheets per user limits, Drive per user limit)
+API_QUOTAS = {'read': 60, 'write': 60, 'drive': 600}
+# Api calls that can be made at once before rate limiting kicks in
+API_BURST = 10
+# Retries of a failing api call before giving up
+API_MAX_RETRIES = 5
+# Seconds of first backoff, doubled on every retry up to API_BACKOFF_MAX
+API_BACKOFF_BASE = 1
+API_BACKOFF_MAX = 64
+# Http statuses worth retrying (quota exceeded, server errors)
+API_RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Seconds api calls failing fast are skipped after google was found unreachable
+API_OFFLINE_BACKOFF = 60
+
+# Local mirror of the ledger sheets
+LEDGER_DB = os.path.join(APP_DIR, 'ledger.sqlite3')
+# Seconds between consistency checks of the mirror against the sheet (1 day)
+MIRROR_SYNC_INTERVAL = 24 * 60 * 60
+# Seconds between full reads of a ledger, checks in between only read rows dated on/after the incoming transactions (1 week)
+MIRROR_REBUILD_INTERVAL = 7 * 24 * 60 * 60
+# Mirror tables: one row per sheet row (A:F) of each ledger, latest category of each description,
+# app state (key -> value), when each ledger was last read from its sheet,
+# monthly spend aggregates of each ledger and updates queued for google sheets
+LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    spreadsheet_id TEXT NOT NULL,
+    ledger TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    fingerprint TEXT,
+    description TEXT,
+    notes TEXT,
+    date INTEGER,
+    amount REAL,
+    balance REAL,
+    category TEXT,
+    PRIMARY KEY (spreadsheet_id, ledger, row)
+);
+CREATE INDEX IF NOT EXISTS transactions_date ON transactions (spreadsheet_id, ledger, date);
+CREATE INDEX IF NOT EXISTS transactions_fingerprint ON transactions (spreadsheet_id, ledger, fingerprint);
+CREATE TABLE IF NOT EXISTS categories (
+    description TEXT PRIMARY KEY,
+    category TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS sync (
+    spreadsheet_id TEXT NOT NULL,
+    ledger TEXT NOT NULL,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (spreadsheet_id, ledger)
+);
+CREATE TABLE IF NOT EXISTS aggregates (
+    spreadsheet_id TEXT NOT NULL,
+    ledger TEXT NOT NULL,
+    month TEXT NOT NULL,
+    grouping TEXT NOT NULL,
+    name TEXT NOT NULL,
+    cents INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (spreadsheet_id, ledger, month, grouping, name)
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    spreadsheet_id TEXT NOT NULL,
+    value_input_option TEXT NOT NULL,
+    data TEXT NOT NULL,
+    guards TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    error TEXT,
+    failed_at REAL
+);
+"""
+
+# Sheet (tab) holding monthly spend aggregates, rewritten after every run that adds rows
+SUMMARY_SHEET = 'Summary'
+SUMMARY_HEADER = ['Month', 'Ledger', 'Group', 'Name', 'Amount', 'Count']
+# Groups of summary rows: whole month, per category, per merchant
+SUMMARY_GROUPS = {'Total': None, 'Category': 'Category', 'Merchant': 'Description'}
+# Name of summary rows of uncategorized transactions
+SUMMARY_UNCATEGORIZED = 'Uncategorized'
+
+# Shortest merchant prefix (characters) a prefix category match is accepted for
+CATEGORY_MIN_PREFIX = 4
+# Lowest confidence a prefix/fuzzy category match is accepted for
+CATEGORY_MIN_CONFIDENCE = 0.6
+# Most known descriptions a fuzzy category match scores (keeps lookups fast when tokens are very common, i.e. CA)
+CATEGORY_MAX_CANDIDATES = 100
+
+# Manifest table: csv files already ingested
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT NOT NULL,
+    ingested_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+"""
+# Name of the budget spreadsheet holding a year's transactions
+SPREADSHEET_NAME_FORMAT = '{year} Budget'
+# Drive files listed per files.list page
+DRIVE_PAGE_SIZE = 100
+# Folder bank statements are downloaded to
+DOWNLOAD_DIR = os.path.join(str(Path.home()), 'Downloads')
+# Seconds before downloaded csv files are cleaned up (5 days)
+CSV_MAX_AGE = 5 * 24 * 60 * 60
+# Watch mode: seconds a csv file has to stay unchanged before it is ingested (still downloading otherwise)
+WATCH_DEBOUNCE = 2
+# Watch mode: seconds between folder scans when inotify is not available
+WATCH_POLL_INTERVAL = 2
+# Watch mode: seconds between clean ups of old csv files
+WATCH_CLEAN_INTERVAL = 24 * 60 * 60
+# Watch mode: seconds between attempts to replay updates queued while google was unreachable
+WATCH_REPLAY_INTERVAL = 60
+
+# How the balance column (E) is written:
+#   values: running balances computed locally, written as plain numbers (nothing for the sheet to recalculate)
+#   array_formula: one SCAN formula in E2 per ledger computing the whole column
+BALANCE_MODE = 'values'
+BALANCE_ARRAY_FORMULA = '=ARRAYFORMULA(IF(D2:D="",,SCAN(0,D2:D,LAMBDA(balance,amount,balance+N(amount)))))'
+
+# Ledger sheets, the categories of the Ledger column
+LEDGERS = ['Debit','Credit']
+# Column types of a parsed transactions frame:
+#   Ledger/Description: categoricals, a small code per row with each distinct string stored once
+#   Date: google sheets date serial
+#   Cents: amount in whole cents, so comparisons and sums are exact
+TRANSACTION_DTYPES = {'Ledger': 'category', 'Description': 'category', 'Date': 'int32', 'Cents': 'int64'}
+# Default number of processes parsing input csv files (1 parses in the main process)
+PARSE_WORKERS = 1
+# Default rows read at once when streaming input csv files
+CSV_CHUNK_SIZE = 50000
+# Bank statement formats, detected from the csv header (see register_bank_format):
+#   ledger: sheet transactions are added to
+#   signature: header columns identifying the bank (all of them must be present)
+#   dtypes: only columns read from the csv, with their types
+#   description/date: columns holding the description and date of a transaction
+#   date_format: strptime format of dates
+#   amount: columns holding the amount, first non blank one wins (i.e. separate debit/credit columns)
+#   amount_format: number, or accounting for text like ($1,234.50)
+#   sign: 1 keeps amounts as exported, -1 flips them
+#   pending: description marking pending transactions listed first, dropped until posted (None keeps every row)
+#   descending: bank lists transactions in DESC order BY date
+BANK_FORMATS = {
+    'PSCU': {
+        'ledger': 'Debit',
+        'signature': ['Check Number', 'Description', 'Date', 'Amount'],
+        'dtypes': {'Description': 'object', 'Date': 'object', 'Amount': 'object'},
+        'description': 'Description',
+        'date': 'Date',
+        'date_format': '%m/%d/%Y',
+        'amount': ['Amount'],
+        'amount_format': 'accounting',
+        'sign': 1,
+        'pending': 'Pending',
+        'descending': False,
+    },
+    'CITI': {
+        'ledger': 'Credit',
+        'signature': ['Member Name', 'Description', 'Date', 'Debit', 'Credit'],
+        'dtypes': {'Description': 'object', 'Date': 'object', 'Debit': 'float64', 'Credit': 'float64'},
+        'description': 'Description',
+        'date': 'Date',
+        'date_format': '%m/%d/%Y',
+        'amount': ['Debit', 'Credit'],
+        'amount_format': 'number',
+        'sign': 1,
+        'pending': None,
+        'descending': True,
+    },
+    'CHASE': {
+        'ledger': 'Debit',
+        'signature': ['Posting Date', 'Details', 'Description', 'Amount'],
+        'dtypes': {'Description': 'object', 'Posting Date': 'object', 'Amount': 'float64'},
+        'description': 'Description',
+        'date': 'Posting Date',
+        'date_format': '%m/%d/%Y',
+        'amount': ['Amount'],
+        'amount_format': 'number',
+        'sign': 1,
+        'pending': None,
+        'descending': True,
+    },
+}
+# Day zero of google sheets date serial numbers
+SERIAL_EPOCH = date(1899, 12, 30)
+
+class DiscoveryCache:
+    """
+    On-disk cache of Google API discovery documents, used by googleapiclient build()
+    Args:   cache_dir: directory to store discovery documents in
+            ttl: seconds a cached document stays valid
+    """
+    def __init__(self,cache_dir=DISCOVERY_CACHE_DIR,ttl=DISCOVERY_CACHE_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def _path(self,url):
+        # One file per discovery url
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self,url):
+        path = self._path(url)
+        try:
+            # Cached document expired, let build() fetch it again
+            if time.time() - os.stat(path).st_mtime > self.ttl:
+                return None
+            with open(path, encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self,url,content):
+        path = self._path(url)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write to temporary file first so readers never see a partial document
+            temp_path = path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(temp_path, path)
+        except OSError:
+            # Caching is best effort only
+            pass
+
+class TokenBucket:
+    """
+    Thread safe token bucket rate limiter
+    Args:   rate: tokens added per second
+            capacity: max tokens (burst size)
+    """
+    def __init__(self,rate,capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Wait until a token is available, then take it
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class RequestScheduler:
+    """
+    Quota aware scheduler every Sheets/Drive api call goes through
+    Calls are rate limited per quota bucket, retried with exponential backoff and jitter on 429/5xx/network errors,
+    and timed; value updates queued for the same spreadsheet are merged into one batchUpdate
+    While failing fast (see failing_fast) network errors are not retried
+    Args:   None
+    """
+    def __init__(self):
+        # One token bucket per quota: Sheets reads, Sheets writes, Drive
+        self.buckets = {bucket: TokenBucket(per_minute / 60, API_BURST) for (bucket, per_minute) in API_QUOTAS.items()}
+        self.lock = threading.Lock()
+        # Seconds taken by each call (retries included), by api method
+        self.latencies = defaultdict(list)
+        # [bytes sent, bytes received] by api method
+        self.transferred = defaultdict(lambda: [0, 0])
+        # Queued value updates: (spreadsheet id, value input option) -> list of value ranges
+        self.pending_updates = defaultdict(list)
+        # Network errors are raised right away instead of retried
+        self.fail_fast = False
+        # Monotonic time until which calls failing fast are not even tried
+        self.offline_until = 0
+
+    @contextlib.contextmanager
+    def failing_fast(self,enabled=True):
+        """
+        Fail fast within a block: network errors are not retried, and once google was unreachable
+        every call raises ConnectionError right away for API_OFFLINE_BACKOFF seconds (429/5xx are still retried)
+        Args:   enabled: fail fast (False keeps retrying)
+        Return: context manager
+        """
+        previous = self.fail_fast
+        self.fail_fast = enabled
+        try:
+            yield self
+        finally:
+            self.fail_fast = previous
+
+    def execute(self,request):
+        """
+        Execute an api request within quota, retrying transient errors
+        Args:   request: googleapiclient request
+        Return: response of request
+        """
+        from googleapiclient.errors import HttpError
+        method_id = getattr(request, 'methodId', None) or 'unknown'
+        bucket = quota_bucket(method_id, getattr(request, 'method', 'GET'))
+        # Request body size, sent again on every retry
+        body = getattr(request, 'body', None) or ''
+        sent = len(body.encode() if isinstance(body, str) else body)
+        received = [0]
+        # Raw response size, counted before the body is parsed
+        postproc = getattr(request, 'postproc', None)
+        if postproc:
+            def counting_postproc(resp,content):
+                received[0] += len(content or b'')
+                return postproc(resp, content)
+            request.postproc = counting_postproc
+        start = time.monotonic()
+        # Google found unreachable moments ago
+        if self.fail_fast and start < self.offline_until:
+            raise ConnectionError('Google unreachable, not retried for ' + str(round(self.offline_until - start)) + ' seconds')
+        attempt = 0
+        while True:
+            self.buckets[bucket].acquire()
+            try:
+                response = request.execute(num_retries=0)
+                break
+            except (HttpError, OSError, httplib2.HttpLib2Error) as error:
+                offline = self.fail_fast and not isinstance(error, HttpError)
+                if offline:
+                    self.offline_until = time.monotonic() + API_OFFLINE_BACKOFF
+                if offline or attempt >= API_MAX_RETRIES or not is_transient_error(error):
+                    self._record(method_id, time.monotonic() - start, sent * (attempt + 1), received[0])
+                    raise
+                # Exponential backoff with full jitter
+                time.sleep(random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt)))
+                attempt += 1
+        self._record(method_id, time.monotonic() - start, sent * (attempt + 1), received[0])
+        return response
+
+    def _record(self,method_id,seconds,sent=0,received=0):
+        with self.lock:
+            self.latencies[method_id].append(seconds)
+            self.transferred[method_id][0] += sent
+            self.transferred[method_id][1] += received
+
+    def queue_update(self,spreadsheet_id,data,value_input_option='USER_ENTERED'):
+        """
+        Queue value ranges to be written with the spreadsheet's other queued updates, see take_updates
+        Args:   spreadsheet_id: id of spreadsheet to be updated
+                data: list of value ranges (range, majorDimension, values)
+                value_input_option: how the values should be interpreted
+        Return: list of positions of data among the updates queued with the same value input option
+        """
+        with self.lock:
+            queue = self.pending_updates[(spreadsheet_id, value_input_option)]
+            queue.extend(data)
+            return list(range(len(queue) - len(data), len(queue)))
+
+    def take_updates(self,spreadsheet_id):
+        """
+        Remove every queued value update of a spreadsheet from the queue
+        Args:   spreadsheet_id: id of spreadsheet to be updated
+        Return: list of (value input option, list of value ranges), without empty ones
+        """
+        with self.lock:
+            keys = [key for key in self.pending_updates if key[0] == spreadsheet_id]
+            batches = [(key[1], self.pending_updates.pop(key)) for key in keys]
+        return [(value_input_option, data) for (value_input_option, data) in batches if data]
+
+    def write_values(self,service,spreadsheet_id,data,value_input_option='USER_ENTERED'):
+        """
+        Write value ranges to a spreadsheet in one batchUpdate
+        Args:   service: sheets service
+                spreadsheet_id: id of spreadsheet to be updated
+                data: list of value ranges (range, majorDimension, values)
+                value_input_option: how the values should be interpreted
+        Return: list of update responses, in data order
+        """
+        # Request body
+        batch_update_values_request_body = {
+            # How the data should be interprested
+            'value_input_option': value_input_option,
+            'data': data
+        }
+        # Calling spreadsheets.values.batchUpdate api
+        request = service.spreadsheets().values().batchUpdate(spreadsheetId=spreadsheet_id, body=batch_update_values_request_body)
+        return self.execute(request).get('responses', [])
+
+    def stats(self):
+        """
+        Summarize call count, latency and bytes transferred of every api method called so far
+        Args:   None
+        Return: dict of method -> dict of calls, total/mean/max seconds, bytes sent/received
+        """
+        with self.lock:
+            return {
+                method_id: {'calls': len(seconds), 'total': sum(seconds), 'mean': sum(seconds) / len(seconds), 'max': max(seconds),
+                    'bytes_sent': self.transferred[method_id][0], 'bytes_received': self.transferred[method_id][1]}
+                for (method_id, seconds) in self.latencies.items()
+            }
+
+def quota_bucket(method_id,http_method):
+    # Quota bucket an api method counts against
+    if method_id.startswith('drive.'):
+        return 'drive'
+    return 'read' if http_method == 'GET' else 'write'
+
+def is_not_found(error):
+    # Spreadsheet or range does not exist (i.e. deleted spreadsheet)
+    from googleapiclient.errors import HttpError
+    return isinstance(error, HttpError) and error.resp.status == 404
+
+def is_transient_error(error):
+    # Quota exceeded, server side or network errors are worth retrying
+    from googleapiclient.errors import HttpError
+    if isinstance(error, HttpError):
+        return error.resp.status in API_RETRY_STATUSES
+    return True
+
+class SheetsSession:
+    """
+    Google Sheets/Drive client session shared by every stage of a run
+    Each service is built once, on first use, and requests run on an authorized keep-alive http transport
+    Every thread gets its own transport since httplib2 connections are not thread safe
+    Args:   creds: credentials for google account
+            sheets: prebuilt sheets service (optional)
+            drive: prebuilt drive service (optional)
+    """
+    def __init__(self,creds,sheets=None,drive=None):
+        self.creds = creds
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sheets = sheets
+        self._drive = drive
+        self._discovery_cache = DiscoveryCache()
+        # Every api call goes through the scheduler
+        self.scheduler = RequestScheduler()
+
+    def execute(self,request):
+        # Execute api request within quota, retrying transient errors
+        return self.scheduler.execute(request)
+
+    @property
+    def http(self):
+        # Authorized http transport of calling thread, connections are kept alive between requests
+        if getattr(self._local, 'http', None) is None:
+            self._local.http = self.creds.authorize(httplib2.Http(timeout=HTTP_TIMEOUT))
+        return self._local.http
+
+    def _request_builder(self,http,*args,**kwargs):
+        # Requests run on the transport of the thread that builds them
+        from googleapiclient.http import HttpRequest
+        return HttpRequest(self.http, *args, **kwargs)
+
+    def _build(self,service_name,version):
+        from googleapiclient.discovery import build
+        return build(service_name, version, http=self.http, cache=self._discovery_cache, static_discovery=False, requestBuilder=self._request_builder)
+
+    @property
+    def sheets(self):
+        # Sheets v4 service
+        with self._lock:
+            if self._sheets is None:
+                self._sheets = self._build('sheets', 'v4')
+        return self._sheets
+
+    @property
+    def drive(self):
+        # Drive v3 service
+        with self._lock:
+            if self._drive is None:
+                self._drive = self._build('drive', 'v3')
+        return self._drive
+
+def synchronized(method):
+    # Serialize calls of a method on its instance's lock
+    @functools.wraps(method)
+    def wrapper(self,*args,**kwargs):
+        with self.lock:
+            return method(self,*args,**kwargs)
+    return wrapper
+
+class LedgerMirror:
+    """
+    Local SQLite mirror of every transaction in the ledger sheets
+    Dedup, categorization and balances run against the mirror, only new rows go to the Sheets API
+    The connection is shared by the ledger pipelines, every method holds the mirror's lock
+    Args:   path: sqlite database file
+    """
+    def __init__(self,path=LEDGER_DB):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(LEDGER_SCHEMA)
+        # Categories of mirrored transactions, kept in the same database
+        self.category_index = CategoryIndex(self)
+
+    @synchronized
+    def needs_sync(self,spreadsheet_id,ledger,interval=MIRROR_SYNC_INTERVAL):
+        # Never synced or last consistency check against the sheet is too old
+        row = self.connection.execute('SELECT synced_at FROM sync WHERE spreadsheet_id = ? AND ledger = ?', (spreadsheet_id, ledger)).fetchone()
+        return row is None or time.time() - row[0] > interval
+
+    @synchronized
+    def replace_ledger(self,spreadsheet_id,ledger,values,first_row=2):
+        """
+        Replace a ledger's mirrored rows with the values read from its sheet
+        Args:   spreadsheet_id: google spreadsheet id
+                ledger: Debit/Credit
+                values: sheet rows A:F, starting at first_row and running to the end of the sheet
+                first_row: sheet row of first value, rows above it are kept (default replaces the whole ledger)
+        Return: None
+        """
+        rows = []
+        for (i, value) in enumerate(values):
+            # Skip blank rows, keeping sheet row numbers
+            if not value:
+                continue
+            value = list(value) + [''] * (6 - len(value))
+            rows.append((spreadsheet_id, ledger, first_row + i, row_fingerprint(value), str(value[0]), str(value[1]), to_number(value[2]), to_number(value[3]), to_number(value[4]), str(value[5])))
+
+        with self.connection:
+            self.connection.execute('DELETE FROM transactions WHERE spreadsheet_id = ? AND ledger = ? AND row >= ?', (spreadsheet_id, ledger, first_row))
+            self.connection.executemany('INSERT INTO transactions VALUES (?,?,?,?,?,?,?,?,?,?)', rows)
+            self.connection.execute('INSERT OR REPLACE INTO sync VALUES (?,?,?)', (spreadsheet_id, ledger, time.time()))
+
+        # Latest category of every categorized description (i.e. categories set by hand in the sheet)
+        self.category_index.update({row[4]: row[9] for row in rows if row[9]}.items())
+
+    @synchronized
+    def add_rows(self,spreadsheet_id,ledger,first_row,transactions):
+        """
+        Mirror transactions written to a ledger sheet
+        Args:   spreadsheet_id: google spreadsheet id
+                ledger: Debit/Credit
+                first_row: sheet row of first transaction
+                transactions: frame of written transactions, with Balance/Category columns
+        Return: None
+        """
+        fingerprints = [fingerprint_key(fingerprint) for fingerprint in frame_fingerprints(transactions)]
+        rows = zip(fingerprints, transactions['Description'].tolist(), transactions['Date'].tolist(), (transactions['Cents'] / 100).tolist(),
+            transactions['Balance'].tolist(), transactions['Category'].tolist())
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO transactions VALUES (?,?,?,?,?,?,?,?,?,?)',
+                [(spreadsheet_id, ledger, first_row + i, fingerprint, description, '', date_serial, amount, balance, category)
+                    for (i, (fingerprint, description, date_serial, amount, balance, category)) in enumerate(rows)])
+
+    @synchronized
+    def last_row(self,spreadsheet_id,ledger):
+        # Header row when ledger is empty
+        row = self.connection.execute('SELECT MAX(row) FROM transactions WHERE spreadsheet_id = ? AND ledger = ?', (spreadsheet_id, ledger)).fetchone()
+        return row[0] or 1
+
+    @synchronized
+    def first_row_since(self,spreadsheet_id,ledger,date_serial):
+        # First mirrored row dated on/after a date serial (every row above is older), None if there is none
+        row = self.connection.execute('SELECT MIN(row) FROM transactions WHERE spreadsheet_id = ? AND ledger = ? AND date >= ?', (spreadsheet_id, ledger, date_serial)).fetchone()
+        return row[0]
+
+    @synchronized
+    def expire_sync(self,spreadsheet_id,ledger):
+        # Make the next sync of a ledger read it whole again (i.e. rows landed elsewhere than mirrored)
+        with self.connection:
+            self.connection.execute('UPDATE sync SET synced_at = 0 WHERE spreadsheet_id = ? AND ledger = ?', (spreadsheet_id, ledger))
+            self.connection.execute('DELETE FROM meta WHERE key = ?', (mirror_rebuild_key(spreadsheet_id,ledger),))
+
+    @synchronized
+    def row_fingerprint(self,spreadsheet_id,ledger,row):
+        # Fingerprint key of a mirrored row, None if blank or malformed
+        row = self.connection.execute('SELECT fingerprint FROM transactions WHERE spreadsheet_id = ? AND ledger = ? AND row = ?', (spreadsheet_id, ledger, row)).fetchone()
+        return row[0] if row else None
+
+    @synchronized
+    def fingerprint_index(self,spreadsheet_id,ledger):
+        """
+        Count mirrored transactions of a ledger by fingerprint
+        Args:   spreadsheet_id: google spreadsheet id
+                ledger: Debit/Credit
+        Return: Counter of fingerprint -> number of matching rows
+        """
+        cursor = self.connection.execute('SELECT fingerprint, COUNT(*) FROM transactions WHERE spreadsheet_id = ? AND ledger = ? AND fingerprint IS NOT NULL GROUP BY fingerprint', (spreadsheet_id, ledger))
+        return Counter({parse_fingerprint_key(key): count for (key, count) in cursor})
+
+    @synchronized
+    def balance_rows(self,spreadsheet_id,ledger):
+        # Mirrored (row, amount, balance) of every row with an amount, in sheet order
+        return self.connection.execute('SELECT row, amount, balance FROM transactions WHERE spreadsheet_id = ? AND ledger = ? AND amount IS NOT NULL ORDER BY row', (spreadsheet_id, ledger)).fetchall()
+
+    @synchronized
+    def set_balances(self,spreadsheet_id,ledger,balances):
+        # Store running balances given as (row, balance)
+        with self.connection:
+            self.connection.executemany('UPDATE transactions SET balance = ? WHERE spreadsheet_id = ? AND ledger = ? AND row = ?',
+                [(balance, spreadsheet_id, ledger, row) for (row, balance) in balances])
+
+    @synchronized
+    def get_meta(self,key):
+        # Stored app state value, None if not set
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    @synchronized
+    def set_meta(self,key,value):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?,?)', (key, value))
+
+    @synchronized
+    def meta_keys(self,prefix,value):
+        # Keys starting with prefix that hold value
+        return [key for (key,) in self.connection.execute('SELECT key FROM meta WHERE substr(key, 1, ?) = ? AND value = ?', (len(prefix), prefix, value))]
+
+    @synchronized
+    def delete_meta(self,key):
+        # Remove a stored app state value
+        with self.connection:
+            self.connection.execute('DELETE FROM meta WHERE key = ?', (key,))
+
+    @synchronized
+    def enqueue_outbox(self,spreadsheet_id,value_input_option,data,guards=()):
+        # Durably record value ranges still to be written to a spreadsheet, with the guards of their ledger rows (see commit_write_plans)
+        with self.connection:
+            self.connection.execute('INSERT INTO outbox (spreadsheet_id, value_input_option, data, guards, created_at) VALUES (?,?,?,?,?)',
+                (spreadsheet_id, value_input_option, json.dumps(data), json.dumps(list(guards)), time.time()))
+
+    @synchronized
+    def outbox_entries(self):
+        # Queued (id, spreadsheet id, value input option, value ranges, guards), oldest first, failed updates excluded
+        return [(entry_id, spreadsheet_id, value_input_option, json.loads(data), json.loads(guards)) for (entry_id, spreadsheet_id, value_input_option, data, guards)
+            in self.connection.execute('SELECT id, spreadsheet_id, value_input_option, data, guards FROM outbox WHERE error IS NULL ORDER BY id').fetchall()]
+
+    @synchronized
+    def outbox_count(self,spreadsheet_id=None):
+        # Number of queued updates still to be sent, of one spreadsheet or all of them
+        if spreadsheet_id is None:
+            return self.connection.execute('SELECT COUNT(*) FROM outbox WHERE error IS NULL').fetchone()[0]
+        return self.connection.execute('SELECT COUNT(*) FROM outbox WHERE error IS NULL AND spreadsheet_id = ?', (spreadsheet_id,)).fetchone()[0]
+
+    @synchronized
+    def fail_outbox(self,entry_id,error):
+        # Set a queued update aside for good, it is kept to be listed by status
+        with self.connection:
+            self.connection.execute('UPDATE outbox SET error = ?, failed_at = ? WHERE id = ?', (error, time.time(), entry_id))
+
+    @synchronized
+    def failed_outbox(self):
+        # Updates set aside as (id, spreadsheet id, ranges, error, failed at), oldest first
+        return [(entry_id, spreadsheet_id, [value_range['range'] for value_range in json.loads(data)], error, failed_at) for (entry_id, spreadsheet_id, data, error, failed_at)
+            in self.connection.execute('SELECT id, spreadsheet_id, data, error, failed_at FROM outbox WHERE error IS NOT NULL ORDER BY id').fetchall()]
+
+    @synchronized
+    def delete_outbox(self,entry_id):
+        with self.connection:
+            self.connection.execute('DELETE FROM outbox WHERE id = ?', (entry_id,))
+
+    @synchronized
+    def add_aggregates(self,spreadsheet_id,ledger,aggregates,replace=False):
+        """
+        Add monthly spend aggregates of new rows to a ledger's stored aggregates
+        Args:   spreadsheet_id: google spreadsheet id
+                ledger: Debit/Credit
+                aggregates: list of (month, group, name, cents, count) from monthly_aggregates
+                replace: drop the ledger's stored aggregates first
+        Return: None
+        """
+        with self.connection:
+            if replace:
+                self.connection.execute('DELETE FROM aggregates WHERE spreadsheet_id = ? AND ledger = ?', (spreadsheet_id, ledger))
+            self.connection.executemany('INSERT INTO aggregates VALUES (?,?,?,?,?,?,?) '
+                'ON CONFLICT (spreadsheet_id, ledger, month, grouping, name) DO UPDATE SET cents = cents + excluded.cents, count = count + excluded.count',
+                [(spreadsheet_id, ledger) + tuple(aggregate) for aggregate in aggregates])
+
+    @synchronized
+    def aggregates(self,spreadsheet_id):
+        # Stored (month, ledger, group, name, cents, count) of a spreadsheet, by month, ledger, group then largest amount
+        return self.connection.execute('SELECT month, ledger, grouping, name, cents, count FROM aggregates WHERE spreadsheet_id = ? '
+            "ORDER BY month, ledger, CASE grouping WHEN 'Total' THEN 0 WHEN 'Category' THEN 1 ELSE 2 END, ABS(cents) DESC, name", (spreadsheet_id,)).fetchall()
+
+    @synchronized
+    def ledger_transactions(self,spreadsheet_id,ledger):
+        # Mirrored (description, date serial, amount, category) of every dated row with an amount, in sheet order
+        return self.connection.execute('SELECT description, date, amount, category FROM transactions WHERE spreadsheet_id = ? AND ledger = ? '
+            'AND date IS NOT NULL AND amount IS NOT NULL ORDER BY row', (spreadsheet_id, ledger)).fetchall()
+
+    @synchronized
+    def ledger_status(self):
+        # (spreadsheet id, ledger, last synced, mirrored rows, latest date serial) of every synced ledger
+        return self.connection.execute('SELECT sync.spreadsheet_id, sync.ledger, sync.synced_at, COUNT(transactions.row), MAX(transactions.date) FROM sync '
+            'LEFT JOIN transactions USING (spreadsheet_id, ledger) GROUP BY sync.spreadsheet_id, sync.ledger ORDER BY sync.spreadsheet_id, sync.ledger').fetchall()
+
+    @synchronized
+    def balance_before(self,spreadsheet_id,ledger,row):
+        # Running balance checkpoint: closest mirrored row above row with a balance, 0 if none
+        result = self.connection.execute('SELECT balance FROM transactions WHERE spreadsheet_id = ? AND ledger = ? AND row < ? AND balance IS NOT NULL ORDER BY row DESC LIMIT 1', (spreadsheet_id, ledger, row)).fetchone()
+        return result[0] if result else 0.0
+
+class TrieNode:
+    """
+    Node of the merchant prefix trie of a CategoryIndex
+    Args:   None
+    """
+    __slots__ = ('children', 'categories')
+
+    def __init__(self):
+        # next character -> TrieNode
+        self.children = {}
+        # Counter of category -> number of descriptions starting with this node's prefix
+        self.categories = Counter()
+
+class CategoryIndex:
+    """
+    Persistent index of description -> category, updated incrementally from categorized rows
+    Lookups are tiered: exact description, then merchant prefix trie, then fuzzy token match
+    The table lives in the mirror's database; in-memory lookup structures are built once, on first use
+    Args:   mirror: LedgerMirror holding the index
+    """
+    def __init__(self,mirror):
+        self.mirror = mirror
+        self.lock = mirror.lock
+        self._loaded = False
+        # description -> category
+        self._exact = {}
+        # Trie of casefolded descriptions
+        self._trie = TrieNode()
+        # token -> set of descriptions containing it
+        self._tokens = defaultdict(set)
+        # description -> set of its casefolded tokens
+        self._token_sets = {}
+
+    @synchronized
+    def update(self,pairs):
+        """
+        Set the category of descriptions, writing only those whose category changed
+        Args:   pairs: iterable of (description, category)
+        Return: None
+        """
+        self._load()
+        changed = [(description, category) for (description, category) in pairs if self._exact.get(description) != category]
+        if not changed:
+            return
+        with self.mirror.connection:
+            self.mirror.connection.executemany('INSERT OR REPLACE INTO categories VALUES (?,?,?)', [(description, category, time.time()) for (description, category) in changed])
+        for (description, category) in changed:
+            self._add(description,category)
+
+    @synchronized
+    def lookup(self,description):
+        """
+        Find the category of a description
+        Args:   description: normalized transaction description
+        Return: Tuple of (category, confidence 0-1, tier: exact/prefix/fuzzy), ('', 0.0, None) if not found
+        """
+        self._load()
+
+        # Tier 1: same description seen before
+        if description in self._exact:
+            return (self._exact[description], 1.0, 'exact')
+
+        key = description.casefold()
+        if not key:
+            return ('', 0.0, None)
+
+        # Tier 2: longest merchant prefix shared with a known description
+        node = self._trie
+        depth = 0
+        for character in key:
+            if character not in node.children:
+                break
+            node = node.children[character]
+            depth += 1
+        if depth >= CATEGORY_MIN_PREFIX and node.categories:
+            (category, count) = node.categories.most_common(1)[0]
+            # Share of description matched, weighted by how much known descriptions agree
+            confidence = depth / len(key) * count / sum(node.categories.values())
+            if confidence >= CATEGORY_MIN_CONFIDENCE:
+                return (category, confidence, 'prefix')
+
+        # Tier 3: known description sharing the most tokens (jaccard similarity)
+        tokens = set(key.split())
+        # A match shares at least CATEGORY_MIN_CONFIDENCE of the tokens, so it has one of the rarest tokens but those,
+        # candidates come from these only (the most common tokens are never scanned)
+        rarest = sorted(tokens, key=lambda token: len(self._tokens.get(token, ())))
+        candidates = set()
+        for token in rarest[:len(tokens) - int(len(tokens) * CATEGORY_MIN_CONFIDENCE) + 1]:
+            for candidate in self._tokens.get(token, ()):
+                if len(candidates) >= CATEGORY_MAX_CANDIDATES:
+                    break
+                candidates.add(candidate)
+        best = ('', 0.0, None)
+        for candidate in candidates:
+            candidate_tokens = self._token_sets[candidate]
+            shared = len(tokens & candidate_tokens)
+            confidence = shared / (len(tokens) + len(candidate_tokens) - shared)
+            if confidence > best[1]:
+                best = (self._exact[candidate], confidence, 'fuzzy')
+        if best[1] >= CATEGORY_MIN_CONFIDENCE:
+            return best
+
+        return ('', 0.0, None)
+
+    def _load(self):
+        # Build lookup structures from the persisted index
+        if self._loaded:
+            return
+        self._loaded = True
+        connection = self.mirror.connection
+        # Seed index from mirrored transactions (mirror created before the index existed)
+        if not connection.execute('SELECT 1 FROM categories LIMIT 1').fetchone():
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO categories SELECT description, category, ? FROM transactions WHERE category != '' ORDER BY ledger = 'Credit', row", (time.time(),))
+        for (description, category) in connection.execute('SELECT description, category FROM categories'):
+            self._add(description,category)
+
+    def _add(self,description,category):
+        # Add/replace a description's category in the lookup structures
+        previous = self._exact.get(description)
+        self._exact[description] = category
+        key = description.casefold()
+        node = self._trie
+        for character in key:
+            node = node.children.setdefault(character, TrieNode())
+            if previous is not None:
+                node.categories[previous] -= 1
+                if node.categories[previous] <= 0:
+                    del node.categories[previous]
+            node.categories[category] += 1
+        self._token_sets[description] = frozenset(key.split())
+        for token in self._token_sets[description]:
+            self._tokens[token].add(description)
+
+class IngestManifest:
+    """
+    Persistent manifest of csv files already ingested, keyed on content hash, size and mtime
+    Files are only hashed when their size or mtime changed since they were last seen
+    Args:   path: sqlite database file
+    """
+    def __init__(self,path=LEDGER_DB):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(MANIFEST_SCHEMA)
+        # Files found since last mark_ingested: path -> (size, mtime, sha256)
+        self.pending = {}
+
+    def is_ingested(self,path,stat):
+        """
+        Check whether a file's content was already ingested
+        Args:   path: csv file path
+                stat: os.stat result of file
+        Return: True if file can be skipped
+        """
+        row = self.connection.execute('SELECT size, mtime FROM files WHERE path = ?', (path,)).fetchone()
+        # Unchanged since it was ingested, skip without opening the file
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return True
+
+        sha256 = file_sha256(path)
+        entry = (stat.st_size, stat.st_mtime, sha256)
+
+        # Same content already ingested (i.e. touched file or statement downloaded twice)
+        if self.connection.execute('SELECT 1 FROM files WHERE sha256 = ?', (sha256,)).fetchone():
+            self._record(path,entry)
+            return True
+
+        # Same content found earlier in this batch (i.e. export.csv and export (1).csv), recorded once the batch is ingested
+        if any(pending[2] == sha256 for pending in self.pending.values()):
+            self.pending[path] = entry
+            return True
+
+        if row:
+            print('Changed since last ingest: ' + path)
+        self.pending[path] = entry
+        return False
+
+    def mark_ingested(self):
+        # Record every file found since last call as ingested
+        for (path, entry) in self.pending.items():
+            self._record(path,entry)
+        self.pending = {}
+
+    def _record(self,path,entry):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?)', (path, *entry, time.time()))
+
+class SpreadsheetResolver:
+    """
+    Resolve spreadsheet ids by name, cached in the mirror's meta table
+    Cached ids cost no api call, an invalidated id is looked up again on next use (i.e. spreadsheet deleted or renamed)
+    Args:   session: client session for google account
+            mirror: local mirror whose meta table holds the cache
+    """
+    def __init__(self,session,mirror):
+        self.session = session
+        self.mirror = mirror
+
+    def spreadsheet_id(self,name):
+        """
+        Find the id of a spreadsheet by name
+        Args:   name: spreadsheet name (i.e. 2021 Budget)
+        Return: spreadsheet id, None if no such spreadsheet
+        """
+        key = 'spreadsheet_id:' + name
+        spreadsheet_id = self.mirror.get_meta(key)
+        if spreadsheet_id is None:
+            # One listing caches every budget spreadsheet (i.e. next year's as well)
+            for (found, found_id) in list_budget_spreadsheets(self.session).items():
+                self.mirror.set_meta('spreadsheet_id:' + found, found_id)
+            spreadsheet_id = self.mirror.get_meta(key)
+        return spreadsheet_id
+
+    def invalidate(self,name):
+        # Forget the cached id of a spreadsheet
+        self.mirror.delete_meta('spreadsheet_id:' + name)
+
+    def forget(self,spreadsheet_id):
+        # Forget the cached id of a spreadsheet known by id only (i.e. an update queued for it failed)
+        for key in self.mirror.meta_keys('spreadsheet_id:',spreadsheet_id):
+            self.invalidate(key[len('spreadsheet_id:'):])
+
+def list_budget_spreadsheets(session):
+    """
+    List budget spreadsheets from google drive, following every page of results
+    Args:   session: client session for google account
+    Return: dict of spreadsheet name -> spreadsheet id
+    """
+    service = session.drive
+    spreadsheets = {}
+    page_token = None
+
+    while True:
+        # Call the Drive v3 files.list API
+        results = session.execute(service.files().list(
+            corpora='user',
+            q="name contains 'Budget' and mimeType = 'application/vnd.google-apps.spreadsheet' and trashed = false",
+            pageSize=DRIVE_PAGE_SIZE,
+            pageToken=page_token,
+            spaces='drive',
+            fields="nextPageToken, files(id, name)"))
+        for item in results.get('files', []):
+            # First listed spreadsheet wins when names are duplicated
+            spreadsheets.setdefault(item['name'], item['id'])
+        page_token = results.get('nextPageToken')
+        if not page_token:
             break
 
-    return current_sheet_id
-    
-def get_csv_files():
+    return spreadsheets
+
+def get_csv_files(manifest=None,download_dir=DOWNLOAD_DIR):
     """
     Search downloads folder for csv files
-    Args: None
+    Args:   manifest: manifest of files already ingested, these are skipped (optional)
+            download_dir: folder to search
+    Return: List of csv files sorted by date last modified
+    """
+    # Search all files in PATH, matching CSV files
+    found = [(entry.path, entry.stat()) for entry in os.scandir(download_dir) if entry.is_file() and entry.name.lower().endswith(".csv")]
+    return new_csv_files(found,manifest)
+
+def new_csv_files(found,manifest=None):
+    """
+    Keep csv files not ingested yet
+    Args:   found: list of (path, os.stat result) of csv files
+            manifest: manifest of files already ingested, these are skipped (optional)
     Return: List of csv files sorted by date last modified
     """
-    input_files = SortedDict()
-    # Get path to home directory
-    home = str(Path.home())
-    # Create path to be searched from home (downloads)
-    download_dir = '/Downloads/'
-    # Add search path to home path to get FULL PATH
-    path_to_search = home + download_dir
-    path_to_search_str_length = len(path_to_search)
-    # Search all files in PATH
-    for file in os.listdir(path_to_search):
-        # Match CSV files in PATH
-        if file.lower().endswith(".csv"):
-            # Full file path
-            filename = path_to_search + file
-            # Date last modified of file
-            last_modified = os.stat(filename).st_mtime
-            # Sorting files by date last modified using sorteddict
-            if filename not in input_files:
-                input_files[last_modified] = filename
-
-    # Return sorted file paths
-    return input_files.values()[:]
-
-def csv_to_list(inputFile):
-    """
-    Convert input csv file into transactions list labeled Debit/Credit
+    input_files = []
+    for (path, stat) in found:
+        # Skip files already ingested before pandas ever opens them
+        if manifest and manifest.is_ingested(path,stat):
+            continue
+        input_files.append((stat.st_mtime, path))
+
+    # Return file paths sorted by date last modified (path breaks ties)
+    return [path for (last_modified, path) in sorted(input_files)]
+
+def file_sha256(path):
+    # Hash file content in blocks so large exports are never loaded at once
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def register_bank_format(bank,bank_format):
+    """
+    Add a bank statement format, or replace one, so its csv files are detected and parsed
+    Args:   bank: name of format
+            bank_format: dict of format settings, see BANK_FORMATS
+    Return: None
+    """
+    missing = {'ledger', 'signature', 'dtypes', 'description', 'date', 'date_format', 'amount', 'amount_format', 'sign', 'pending', 'descending'} - set(bank_format)
+    if missing:
+        raise ValueError(bank + ' format is missing ' + ', '.join(sorted(missing)))
+    if bank_format['ledger'] not in LEDGERS:
+        raise ValueError(bank + ' ledger must be one of ' + ', '.join(LEDGERS))
+    if bank_format['amount_format'] not in ('number', 'accounting'):
+        raise ValueError(bank + ' amount format must be number or accounting')
+    # Every column parsed has to be read
+    unread = {bank_format['description'], bank_format['date'], *bank_format['amount']} - set(bank_format['dtypes'])
+    if unread:
+        raise ValueError(bank + ' format does not read ' + ', '.join(sorted(unread)))
+    BANK_FORMATS[bank] = bank_format
+
+def sniff_bank_format(inputFile):
+    """
+    Detect bank statement format from the csv header row alone
+    Args:   inputFile: input csv file
+    Return: BANK_FORMATS key, None if not a bank statement
+    """
+    try:
+        with open(inputFile, newline='', encoding='utf-8-sig', errors='replace') as f:
+            header = set(next(csv.reader([f.readline()]), []))
+    except OSError:
+        return None
+
+    # Most specific signature first, so a format extending another one's columns wins
+    matches = [bank for (bank, bank_format) in BANK_FORMATS.items() if header.issuperset(bank_format['signature'])]
+    if not matches:
+        # csv file not a bank statement
+        return None
+    return max(matches, key=lambda bank: len(BANK_FORMATS[bank]['signature']))
+
+def iter_csv_chunks(inputFile,bank,chunksize=None):
+    """
+    Read a bank statement csv as typed transaction frames of at most chunksize rows
+    Only the needed columns are read, with explicit dtypes
+    Args:   inputFile: input csv file
+            bank: BANK_FORMATS key of input file
+            chunksize: max rows per frame (None reads the whole file as one frame)
+    Return: generator of transaction frames in file order, indexed by row number in file
+    """
+    dtypes = BANK_FORMATS[bank]['dtypes']
+    reader = pandas.read_csv(inputFile, usecols=list(dtypes), dtype=dtypes, chunksize=chunksize)
+
+    # Whole file read at once
+    if chunksize is None:
+        reader = [reader]
+
+    # Parse state carried across chunks of one file
+    state = {}
+    for chunk in reader:
+        yield parse_bank_chunk(bank,chunk,state)
+
+def parse_bank_chunk(bank,chunk,state):
+    """
+    Convert raw bank csv rows into a typed transactions frame
+    Args:   bank: BANK_FORMATS key of rows
+            chunk: DataFrame of raw csv rows
+            state: dict carried between chunks of the same file
+    Return: DataFrame with TRANSACTION_DTYPES columns
+    """
+    bank_format = BANK_FORMATS[bank]
+    descriptions = chunk[bank_format['description']].astype(str)
+
+    # Remove leading pending transactions from frame (TO ELIMINATE DUPLICATES LATER)
+    if bank_format['pending'] and state.get('leading_pending', True):
+        pending = descriptions.str.contains(bank_format['pending'], regex=False)
+        leading_pending = pending.astype(int).cummin().astype(bool)
+        state['leading_pending'] = bool(leading_pending.all())
+        chunk = chunk[~leading_pending]
+        descriptions = descriptions[~leading_pending]
+
+    # Build typed frame (notes are left empty, they are only written to the sheet)
+    transactions = pandas.DataFrame({
+        'Ledger': pandas.Categorical([bank_format['ledger']] * len(chunk), categories=LEDGERS),
+        'Description': pandas.Categorical(descriptions.to_numpy()),
+        # Converting date --> excel date (TO COMPARE RESPONSE FROM GOOGLE API)
+        'Date': date_to_serial(chunk[bank_format['date']],bank_format['date_format']).to_numpy(),
+        'Cents': to_cents(parse_amounts(chunk,bank_format)) * bank_format['sign'],
+    }, index=chunk.index)
+
+    return transactions
+
+def parse_amounts(chunk,bank_format):
+    """
+    Read the amount of raw bank csv rows as floats
+    Args:   chunk: DataFrame of raw csv rows
+            bank_format: BANK_FORMATS entry of rows
+    Return: Series of amounts as exported (blank if no amount column is filled)
+    """
+    amount = None
+    for column in bank_format['amount']:
+        values = chunk[column]
+        if bank_format['amount_format'] == 'accounting':
+            values = parse_accounting_amounts(values)
+        # First non blank column wins
+        amount = values if amount is None else amount.fillna(values)
+    return amount.astype('float64')
+
+def parse_accounting_amounts(amounts):
+    # Amounts as text with negative amounts as ($x,xxx.xx) to float
+    amounts = amounts.astype(str)
+    negative = amounts.str.startswith('(').to_numpy()
+    # Format amount from string to float (FOR INSERTING/READING TO GOOGLE SHEETS)
+    amounts = amounts.str.replace(r'[($),]', '', regex=True).astype(float)
+    return amounts.where(~negative, -amounts)
+
+def assemble_file_frame(bank,frames):
+    """
+    Join transaction frames read from one file into a frame in ASC order by date
+    Args:   bank: BANK_FORMATS key of input file
+            frames: list of transaction frames in file order
+    Return: transactions frame
+    """
+    if frames:
+        transactions = pandas.concat(frames)
+    else:
+        transactions = empty_transactions_frame()
+
+    # Some banks list transactions in DESC order BY date
+    if BANK_FORMATS[bank]['descending']:
+        transactions = transactions.iloc[::-1]
+
+    return transactions.reset_index(drop=True)
+
+def empty_transactions_frame():
+    """
+    Create a typed transactions frame without rows
+    Args:   None
+    Return: empty DataFrame with TRANSACTION_DTYPES columns
+    """
+    transactions = pandas.DataFrame({column: pandas.Series(dtype=dtype) for column, dtype in TRANSACTION_DTYPES.items()})
+    transactions['Ledger'] = transactions['Ledger'].cat.set_categories(LEDGERS)
+    return transactions
+
+def csv_to_frame(inputFile):
+    """
+    Parse input csv file into a typed transactions frame labeled Debit/Credit
     Args: input csv file
-    Return: list of transactions
+    Return: DataFrame with TRANSACTION_DTYPES columns, None if not a bank statement
     """
     #inputFile = 'Statement closed Oct 16, 2019.CSV' # CITI TEST DATA
     #inputFile = 'export_20191018.csv' # PSCU TEST DATA (SMALL SET)
     #inputFile = 'export_20191002.csv' # PSCU TEST DATA (INCLUDES PENDING TRANSACTIONS)
 
-    df = pandas.read_csv(inputFile)
+    bank = sniff_bank_format(inputFile)
 
     # csv file not a bank statement
-    if 'Date' not in df.columns and 'Description' not in df.columns:
+    if bank is None:
         return None
 
-    # PSCU csv to list
-    if 'Check Number' in df.columns:
-        transactions = ['Debit',df[['Description','Comments','Date','Amount']].values.tolist()]
+    return assemble_file_frame(bank,list(iter_csv_chunks(inputFile,bank)))
 
-        # Remove pending transactions from list (TO ELIMINATE DUPLICATES LATER)
-        while True:
-            if transactions[1][0] and ('Pending' in transactions[1][0][0]):
-                transactions[1].pop(0)
-            else:
-                break
-        
-        # Format amount from string to float (FOR INSERTING/READING TO GOOGLE SHEETS)
-        for item in transactions[1]:
-            # Limiting character count for transaction name
-            #item[0] = item[0][:21]
-            # Inserting placeholder for notes
-            item[1] = ''
-            # PSCU list negative amounts as ($xx.xx)
-            if item[3][0] == '(':
-                # Convert string to negative float
-                item[3] = -(float(item[3].strip('($)').replace(',','')))
-            else:
-                # Convert string to positive float
-                item[3] = float(item[3].strip('($)').replace(',',''))
-            
-    # CITI csv to list
-    elif 'Member Name' in df.columns:
-        df['Debit'] = df['Debit'].fillna(df['Credit'])
-        transactions = df[['Description','Member Name','Date','Debit']].values.tolist()
-        # Inserting a placeholder for notes
-        for item in transactions:
-            item[1] = ''
-        # CITI lists transactions in DESC order BY date
-        transactions.reverse()
-        transactions = ['Credit', transactions]
-
-    # CHASE csv to list
-    elif 'Posting Date' in df.columns:
-        transactions = df[['Description','Details','Posting Date','Amount']]
-        # Inserting a placeholder for notes
-        for item in transactions:
-            item[1] = ''
-        transactions = ['Debit', transactions]
+def stream_new_transactions(input_files,sheet_index,chunksize=CSV_CHUNK_SIZE):
+    """
+    Read input files chunk by chunk, normalizing and deduplicating each chunk as it is read
+    Only new transactions are kept, so memory stays bounded by the chunk size
+    Args:   input_files: list of input csv files
+            sheet_index: function of (Debit/Credit, year) -> fingerprint index of rows already in that year's sheet,
+                         called the first time a chunk has rows of the year
+            chunksize: max rows read from a file at once
+    Return: generator of frames of new transactions, one per bank statement file
+    """
+    # Rows already in the sheets still to be matched, used up as chunks are read (fingerprints of different years never match)
+    remaining = defaultdict(Counter)
+    loaded = set()
+    # Most rows of each fingerprint in any one file read so far, overlapping files merge as a multiset union
+    seen = defaultdict(Counter)
 
+    for file in input_files:
+        bank = sniff_bank_format(file)
+
+        # csv file not a bank statement
+        if bank is None:
+            continue
+
+        ledger = BANK_FORMATS[bank]['ledger']
+
+        new_frames = []
+        file_counts = Counter()
+        for chunk in iter_csv_chunks(file,bank,chunksize):
+            # Sheet rows of years seen for the first time
+            for year in numpy.unique(serial_years(chunk['Date'])).tolist():
+                if (ledger, year) not in loaded:
+                    remaining[ledger].update(sheet_index(ledger,year))
+                    loaded.add((ledger, year))
+            # Normalize merchant names before comparing to the sheet
+            chunk['Description'] = normalize_descriptions(chunk['Description'])
+            # Rows an earlier file already has were matched (or kept) with that file
+            chunk = union_file_transactions(chunk,seen[ledger],file_counts)
+            new_frames.append(consume_indexed_transactions(chunk,remaining[ledger]))
+        seen[ledger] |= file_counts
+
+        yield assemble_file_frame(bank,new_frames)
+
+def parse_csv_files(input_files,workers=PARSE_WORKERS):
+    """
+    Parse input csv files into transaction frames, in a process pool when more than one worker is requested
+    Args:   input_files: list of input csv files
+            workers: number of processes parsing input files (1 parses in this process)
+    Return: list of transaction frames of bank statement files, in input file order
+    """
+    input_files = list(input_files)
+
+    # Parsing is CPU bound, spread files across processes
+    if workers > 1 and len(input_files) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(input_files))) as executor:
+            # map keeps results in input file order so the merged frame is deterministic
+            frames = list(executor.map(csv_to_frame, input_files))
     else:
-        return None
+        frames = [csv_to_frame(file) for file in input_files]
 
-    return transactions
+    # transactions don't exist for input file
+    return [frame for frame in frames if frame is not None]
+
+def date_to_serial(dates,date_format='%m/%d/%Y'):
+    """
+    Convert date strings to google sheets date serial numbers
+    Args:   dates: Series of date strings
+            date_format: strptime format of dates
+    Return: Series of serial numbers (days since 12/30/1899 as int32)
+    """
+    return (pandas.to_datetime(dates, format=date_format) - pandas.Timestamp(SERIAL_EPOCH)).dt.days.astype('int32')
+
+def serial_years(dates):
+    """
+    Calendar year of google sheets date serial numbers
+    Args:   dates: Series of date serials
+    Return: numpy int array of years
+    """
+    days = numpy.datetime64(SERIAL_EPOCH, 'D') + dates.to_numpy().astype('timedelta64[D]')
+    return days.astype('datetime64[Y]').astype('int64') + 1970
+
+def serial_months(dates):
+    """
+    Calendar month of google sheets date serial numbers
+    Args:   dates: Series of date serials
+    Return: numpy array of months as YYYY-MM
+    """
+    days = numpy.datetime64(SERIAL_EPOCH, 'D') + dates.to_numpy().astype('timedelta64[D]')
+    return days.astype('datetime64[M]').astype(str)
+
+def to_cents(amounts):
+    """
+    Convert amounts in dollars to whole cents
+    Args:   amounts: sequence of amounts (blank amounts count as 0)
+    Return: numpy int64 array of cents
+    """
+    return numpy.rint(numpy.nan_to_num(numpy.asarray(amounts, dtype='float64')) * 100).astype('int64')
 
-def compare_sheet_data_to_csv_data(trans_type,transactions,spreadsheet_id,creds):
+def compare_sheet_data_to_csv_data(trans_type,transactions,spreadsheet_id,session,mirror):
     """
-    Edit transaction list to contain new data only
-    Args:   transactions: list of transactions
+    Edit transactions frame to contain new data only
+    Args:   trans_type: Debit/Credit
+            transactions: frame of transactions
             spreadsheet_id: spreadsheet id of google spreadsheet to read
-            creds: credentials for google account
+            session: client session for google account
+            mirror: local mirror of the ledger sheets
+    """
+    # Make sure mirror is consistent with the sheet, where rows as old as the oldest transaction may be
+    since = int(transactions['Date'].min()) if len(transactions) else None
+    sync_ledger_mirror(trans_type,spreadsheet_id,session,mirror,since=since)
+
+    # Index transactions already in the sheet by fingerprint
+    sheet_index = mirror.fingerprint_index(spreadsheet_id,trans_type)
+
+    # Keep only transactions not already accounted for in the sheet
+    return remove_indexed_transactions(transactions,sheet_index)
+
+def sync_ledger_mirror(trans_type,spreadsheet_id,session,mirror,force=False,since=None):
+    """
+    Rebuild a ledger's mirror from its sheet when it was never synced, its last consistency check is too old
+    or rows were added below its last mirrored row since (by hand or by another tool), so new rows never overwrite them
+    Between full rebuilds only the tail of the ledger that can hold the incoming transactions is read:
+    the mirror's row -> date index gives the first row dated on/after since, the mirrored row above it anchors the window
+    Args:   trans_type: Debit/Credit
+            spreadsheet_id: spreadsheet id of google spreadsheet to read
+            session: client session for google account
+            mirror: local mirror of the ledger sheets
+            force: rebuild the whole ledger even if the mirror is up to date
+            since: date serial of the oldest incoming transaction (default reads the whole ledger)
+    Return: True if the mirror was rebuilt
+    """
+    # Sheet is behind the mirror until queued updates are replayed, rebuilding now would drop them
+    if mirror.outbox_count(spreadsheet_id):
+        return False
+
+    # Window of rows to read, from the row above the first one dated on/after since
+    first_row = 2
+    rebuild_key = mirror_rebuild_key(spreadsheet_id,trans_type)
+    if since is not None and not force and time.time() - float(mirror.get_meta(rebuild_key) or 0) < MIRROR_REBUILD_INTERVAL:
+        first_row = max(2, (mirror.first_row_since(spreadsheet_id,trans_type,since) or mirror.last_row(spreadsheet_id,trans_type) + 1) - 1)
+
+    from googleapiclient.errors import HttpError
+    try:
+        # Consistency check not due: the sheet only has to end where the mirror does
+        if not (force or mirror.needs_sync(spreadsheet_id,trans_type)) and ledger_tail_matches(trans_type,spreadsheet_id,session,mirror):
+            return False
+        values = read_ledger_rows(trans_type,spreadsheet_id,session,first_row)
+        # Rows inserted/deleted above the window moved the anchor row, read the whole ledger again
+        if first_row > 2 and row_fingerprint(values[0] if values else []) != mirror.row_fingerprint(spreadsheet_id,trans_type,first_row):
+            first_row = 2
+            values = read_ledger_rows(trans_type,spreadsheet_id,session,first_row)
+    except (HttpError, OSError, httplib2.HttpLib2Error) as error:
+        # Google unreachable: a mirror synced before is still good enough to deduplicate against
+        if is_transient_error(error) and not force and not mirror.needs_sync(spreadsheet_id,trans_type,float('inf')):
+            print(trans_type + ' ledger not synced, using local mirror: ' + repr(error))
+            return False
+        raise
+
+    mirror.replace_ledger(spreadsheet_id,trans_type,values,first_row)
+    if first_row == 2:
+        mirror.set_meta(rebuild_key,str(time.time()))
+        # Whole ledger read, aggregates pick up rows edited by hand
+        rebuild_aggregates(trans_type,spreadsheet_id,mirror)
+
+    # Rows inserted/edited in the sheet since last sync leave plain balances below them stale, rebased with the next write
+    mirror.set_meta(balance_rebase_key(spreadsheet_id,trans_type),'1')
+    return True
+
+def read_ledger_rows(trans_type,spreadsheet_id,session,first_row=2):
+    """
+    Read a ledger sheet from a row down to its last row
+    Args:   trans_type: Debit/Credit
+            spreadsheet_id: spreadsheet id of google spreadsheet to read
+            session: client session for google account
+            first_row: sheet row to start reading at
+    Return: list of sheet rows A:F (blank rows as empty lists)
     """
     # Define sheets service
-    service = build('sheets', 'v4', credentials=creds)
-    # Read date from google sheet
-    if trans_type == 'Debit':
-        read_range = 'Debit!A2:D500'
-    elif trans_type == 'Credit':
-        read_range = 'Credit!A2:D500'
-
-    # Value retrieves amount as number
-    value_render_option = 'FORMULA'
+    service = session.sheets
+    # Read ledger tail from google sheet
+    read_range = trans_type + '!A' + str(first_row) + ':F'
+
+    # Value retrieves amount/balance as number
+    value_render_option = 'UNFORMATTED_VALUE'
     # Value retrieves date as serial number (days since 12/30/1899 as integer)
     date_time_render_option = 'SERIAL_NUMBER'
     # Calling spreadsheets.values.get api
     request = service.spreadsheets().values().get(spreadsheetId=spreadsheet_id,range=read_range,valueRenderOption=value_render_option, dateTimeRenderOption=date_time_render_option)
-    response = request.execute()
+    return session.execute(request).get('values', [])
 
-    # Saving data from response
-    if response.get('values'):
-        sheet_data = response['values']
-    else:
-        sheet_data = []
+def ledger_tail_matches(trans_type,spreadsheet_id,session,mirror):
+    """
+    Check that a ledger sheet ends with its last mirrored row, reading from that row down
+    Args:   trans_type: Debit/Credit
+            spreadsheet_id: spreadsheet id of google spreadsheet to read
+            session: client session for google account
+            mirror: local mirror of the ledger sheets
+    Return: True if no row was added, removed or changed at the end of the sheet
+    """
+    last_row = mirror.last_row(spreadsheet_id,trans_type)
+    values = read_ledger_rows(trans_type,spreadsheet_id,session,max(2, last_row))
+    # Empty ledger
+    if last_row < 2:
+        return not values
+    return len(values) == 1 and row_fingerprint(values[0]) == mirror.row_fingerprint(spreadsheet_id,trans_type,last_row)
+
+def mirror_rebuild_key(spreadsheet_id,trans_type):
+    # Mirror meta key holding when a ledger was last read whole
+    return 'rebuilt:' + spreadsheet_id + ':' + trans_type
+
+def row_fingerprint(value):
+    # Fingerprint key of a sheet row, None for blank or malformed rows (i.e. totals) which never match a transaction
+    try:
+        return fingerprint_key(transaction_fingerprint(value))
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def transaction_fingerprint(transaction):
+    """
+    Normalized key identifying a transaction for deduplication
+    Args:   transaction: transaction row [description, notes, date serial, amount]
+    Return: tuple of (description, date serial, amount in cents)
+    """
+    description = ' '.join(str(transaction[0]).split()).casefold()
+    date_serial = int(float(transaction[2]))
+    # Compare amounts as whole cents to avoid float equality issues
+    amount_cents = int(round(float(transaction[3]) * 100))
+    return (description, date_serial, amount_cents)
+
+def fingerprint_key(fingerprint):
+    # Fingerprint tuple as text (descriptions never contain tabs once normalized)
+    return '\t'.join(str(part) for part in fingerprint)
+
+def parse_fingerprint_key(key):
+    # Text fingerprint back to a tuple
+    (description, date_serial, amount_cents) = key.rsplit('\t', 2)
+    return (description, int(date_serial), int(amount_cents))
+
+def to_number(value):
+    # Sheet cell as a number, None if blank or not numeric
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
 
-    # Converting date --> datetime then datetime --> excel date (TO COMPARE RESPONSE FROM GOOGLE API)
-    for transaction in transactions:
-        transaction[2] = datetime.strptime(transaction[2], '%m/%d/%Y').date()
-        temp = datetime(1899, 12, 30).date()
-        transaction[2] = (transaction[2] - temp).days
+def frame_fingerprints(transactions):
+    """
+    Vectorized transaction_fingerprint for a transactions frame
+    Args:   transactions: frame of transactions
+    Return: list of fingerprint tuples, in frame order
+    """
+    description = transactions['Description'].astype(str).str.split().str.join(' ').str.casefold()
+    return list(zip(description, transactions['Date'].tolist(), transactions['Cents'].tolist()))
 
-    ### DEBUG ###
-    #   print(trans_list[2])
-    #   print(sheet_data[26])
+def remove_indexed_transactions(transactions,index):
+    """
+    Remove transactions already present in a fingerprint index
+    Each indexed row cancels out one matching transaction, so real repeated transactions survive
+    Args:   transactions: frame of transactions
+            index: Counter of fingerprint -> number of rows already present
+    Return: frame of new transactions, in original order
+    """
+    # Copy so the caller's index is left untouched
+    return consume_indexed_transactions(transactions,Counter(index))
 
-    # If csv element in sheet_data, remove first element of csv list
-    while True:
-        # nothing to read from range, add all transactions
-        if len(sheet_data) == 0:
-            break
-        # Whole transaction list is already in the sheet
-        if transactions[-1] in sheet_data:
-            transactions = []
-            break
-        # Transaction list is not empty and transaction is already present in google sheet
-        ##########   NOTE: COMPARISON HAPPENS HERE. PLEASE FINE TUNE COMPARISONS #############
-        if transactions and (transactions[0] in sheet_data):
-            transactions.pop(0)
+def consume_indexed_transactions(transactions,remaining):
+    """
+    Remove transactions present in a fingerprint index, using up one indexed row per removed transaction
+    Args:   transactions: frame of transactions
+            remaining: Counter of fingerprint -> number of rows still to be matched (updated in place)
+    Return: frame of new transactions, in original order
+    """
+    # Nothing to compare against
+    if not remaining or transactions.empty:
+        return transactions
+
+    keep = []
+    for fingerprint in frame_fingerprints(transactions):
+        # Transaction already present, use up one matching row
+        if remaining.get(fingerprint, 0) > 0:
+            remaining[fingerprint] -= 1
+            keep.append(False)
         else:
-            break
-    # Loop until False (csv element not in sheet_data)
-    return transactions
+            keep.append(True)
+    return transactions[keep]
 
-def csv_list_to_sheet(trans_type,transactions,spreadsheet_id,creds):
+def union_file_transactions(transactions,seen,file_counts):
     """
-    Insert transaction list to google spreadsheet
-    Args:   transactions: list of transactions
-            spreadsheet_id: spreadsheet id of google spreadsheet to update
-            creds: credentials for google account 
-    Return: Range of values updated
+    Remove transactions an earlier file of the run already has, so overlapping statements merge as a multiset union
+    A transaction repeated n times in one file and m times in another is kept max(n, m) times, not n + m
+    Args:   transactions: frame of normalized transactions of one file (or of a chunk of it)
+            seen: Counter of fingerprint -> most rows of it in any one earlier file
+            file_counts: Counter of fingerprint -> rows of it already read from this file (updated in place)
+    Return: frame of transactions not in an earlier file, in original order
     """
-    # Define sheets service
-    service = build('sheets', 'v4', credentials=creds)
-    # Range to enter new items
-    if trans_type == 'Debit':
-        range_ = 'Debit!A1:F6'
-    elif trans_type == 'Credit':
-        range_ = 'Credit!A1:F6'
+    if transactions.empty:
+        return transactions
 
-    # Value to enter values as if doing it on google sheets UI
-    value_input_option = 'USER_ENTERED'
+    keep = []
+    for fingerprint in frame_fingerprints(transactions):
+        # Occurrences up to the count of an earlier file are that file's rows again
+        keep.append(file_counts[fingerprint] >= seen.get(fingerprint, 0))
+        file_counts[fingerprint] += 1
+    return transactions[keep]
 
-    # Value to append and not overwrite
-    insert_data_option = 'INSERT_ROWS'
+def union_transactions(frames):
+    """
+    Merge the transaction frames of a run's files as a multiset union, see union_file_transactions
+    Args:   frames: list of normalized transaction frames, one per file, in input file order
+    Return: list of frames of transactions not in an earlier file, same order
+    """
+    # Fingerprints of different ledgers never match
+    seen = defaultdict(Counter)
+    merged = []
+    for frame in frames:
+        if frame.empty:
+            continue
+        ledger = frame['Ledger'].iloc[0]
+        file_counts = Counter()
+        merged.append(union_file_transactions(frame,seen[ledger],file_counts))
+        # Counter union keeps the largest count of each fingerprint
+        seen[ledger] |= file_counts
+    return merged
+
+class RunProfiler:
+    """
+    Wall time, CPU time and rows processed of every pipeline stage of a run
+    CPU time is the calling thread's, work done in the parse process pool only shows as wall time
+    Args:   profile_stages: dict of stage name -> file the stage's cProfile stats are dumped to (optional)
+    """
+    def __init__(self,profile_stages=None):
+        self.profile_stages = profile_stages or {}
+        self.lock = threading.Lock()
+        # Stage name -> dict of calls, wall/cpu seconds, rows
+        self.stages = {}
+        self.started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self,name,rows=None):
+        """
+        Time the enclosed block as a pipeline stage
+        Args:   name: stage name, stages run more than once are added up
+                rows: rows processed by the stage (can be set on the yielded dict instead)
+        Return: context manager yielding a dict whose 'rows' key is recorded when the block exits
+        """
+        record = {'rows': rows}
+        profile = cProfile.Profile() if name in self.profile_stages else None
+        if profile:
+            profile.enable()
+        (wall, cpu) = (time.perf_counter(), time.thread_time())
+        try:
+            yield record
+        finally:
+            (wall, cpu) = (time.perf_counter() - wall, time.thread_time() - cpu)
+            if profile:
+                profile.disable()
+                profile.dump_stats(self.profile_stages[name])
+            with self.lock:
+                stage = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'rows': 0})
+                stage['calls'] += 1
+                stage['wall'] += wall
+                stage['cpu'] += cpu
+                stage['rows'] += record['rows'] or 0
+
+    def report(self,session=None):
+        """
+        Summarize the run so far
+        Args:   session: client session whose api calls are included (optional)
+        Return: dict of wall seconds, stages and api calls by method
+        """
+        with self.lock:
+            stages = {name: dict(stage) for (name, stage) in self.stages.items()}
+        return {
+            'wall': time.perf_counter() - self.started,
+            'stages': stages,
+            'api': session.scheduler.stats() if session else {},
+        }
+
+    def write_report(self,path,session=None):
+        # Save report as json
+        with open(path, 'w') as f:
+            json.dump(self.report(session), f, indent=2)
+
+class LedgerResult:
+    """
+    Outcome of one ledger's pipeline for a run
+    Args:   ledger: Debit/Credit
+    """
+    def __init__(self,ledger):
+        self.ledger = ledger
+        # Frame of transactions handled by the pipeline (new transactions once deduplicated)
+        self.transactions = None
+        # Range where new rows landed, None if nothing was added
+        self.updated_range = None
+        # Exception that stopped the pipeline, None if it succeeded
+        self.error = None
+
+class IngestResult:
+    """
+    Combined outcome of the Debit and Credit pipelines of a run
+    Args:   None
+    """
+    def __init__(self):
+        self.debit = LedgerResult('Debit')
+        self.credit = LedgerResult('Credit')
 
-    # Setting transaction list as values to be added to sheet
-    value_range_body = {"values": transactions}
+    def __iter__(self):
+        return iter((self.debit, self.credit))
 
-    # Calling spreadsheets.values.append api
-    request = service.spreadsheets().values().append(spreadsheetId=spreadsheet_id, range=range_, valueInputOption=value_input_option, insertDataOption=insert_data_option, body=value_range_body)
-    response = request.execute()
+    @property
+    def updated_range(self):
+        # Tuple of (debit, credit) range of rows added
+        return (self.debit.updated_range, self.credit.updated_range)
 
-    return response['updates']['updatedRange']
+    @property
+    def errors(self):
+        # dict of ledger -> exception for failed pipelines
+        return {ledger_result.ledger: ledger_result.error for ledger_result in self if ledger_result.error}
 
-def input_file_to_sheet(input_files,spreadsheet_id,creds):
+def run_ledger_pipelines(stage,result,concurrent=True):
     """
-    Extract transactions from input files, edit transaction list for new data only, add data to google spreadsheet
-    Args:   input_files: list of input csv files
-            spreadsheet_id: spreadsheet id of google spreadsheet to update
-            creds: credentials for google account 
-    Return: Tuple of range of values updated
+    Run a pipeline stage for the Debit and Credit ledgers, concurrently or one after the other
+    A ledger whose stage fails records its error without stopping the other ledger
+    Args:   stage: function called with the LedgerResult of each ledger that has not failed yet
+            result: IngestResult of the run
+            concurrent: run both ledgers at the same time in a thread pool
+    Return: None
     """
-    # Create master debit/credit transaction lists
-    debit_transactions = []
-    credit_transactions = []
-
-    # get transactions list for each input file
-    for file in input_files:
-        transactions = csv_to_list(file)
-
-        # transactions don't exist for input file
-        if not transactions:
-            continue
+    def run(ledger_result):
+        try:
+            stage(ledger_result)
+        except Exception as error:
+            ledger_result.error = error
+
+    pending = [ledger_result for ledger_result in result if ledger_result.error is None]
+
+    # Ledgers are independent tabs, mostly waiting on the Sheets API
+    if concurrent and len(pending) > 1:
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            list(executor.map(run, pending))
+    else:
+        for ledger_result in pending:
+            run(ledger_result)
 
-        # populate master debit transactions list
-        if transactions[0] == 'Debit':
-            debit_transactions += transactions[1]
-        # populate master credit transactions list
-        elif transactions[0] == 'Credit':
-            credit_transactions += transactions[1]
+def concat_transactions(frames):
+    """
+    Join transaction frames into one frame in ASC order by date, keeping file order within a day
+    Args:   frames: list of transaction frames
+    Return: transactions frame
+    """
+    if not frames:
+        return empty_transactions_frame()
 
-    # sort master debit/credit transaction lists
-    debit_transactions.sort(key=itemgetter(2))
-    credit_transactions.sort(key=itemgetter(2))
+    transactions = pandas.concat(frames, ignore_index=True)
+    # Merchants of different files back to one categorical
+    transactions['Description'] = transactions['Description'].astype('category')
+    # sort master transactions frame by date, keeping file order within a day
+    return transactions.sort_values('Date', kind='stable')
 
-    for transaction in debit_transactions:
-        transaction[0] = extract_useful_string(transaction[0])
-    #   print(transaction[0])
-    for transaction in credit_transactions:
-        transaction[0] = extract_useful_string(transaction[0])
+def read_transactions(input_files,workers=PARSE_WORKERS,profiler=None):
+    """
+    Parse every input file into one normalized transactions frame for this run
+    Args:   input_files: list of input csv files
+            workers: number of processes parsing input files
+            profiler: RunProfiler timing each stage (optional)
+    Return: transactions frame in ASC order by date, with normalized descriptions
+    """
+    profiler = profiler or RunProfiler()
 
-    debit_range = None
-    credit_range = None
+    with profiler.stage('parse') as stage:
+        frames = parse_csv_files(input_files,workers)
+        rows = stage['rows'] = sum(len(frame) for frame in frames)
 
-    # Edit debit transaction list to contain only new data, add list to google spreadsheet
-    debit_transactions = compare_sheet_data_to_csv_data('Debit',debit_transactions,spreadsheet_id,creds)
-    if(len(debit_transactions) != 0):
-        debit_range = csv_list_to_sheet('Debit',debit_transactions,spreadsheet_id,creds)
-        #pass
+    # Normalize merchant names before files are compared
+    with profiler.stage('normalize',rows):
+        for frame in frames:
+            frame['Description'] = normalize_descriptions(frame['Description'])
 
-    # Edit credit transaction list to contain only new data, add list to google spreadsheet
-    credit_transactions = compare_sheet_data_to_csv_data('Credit',credit_transactions,spreadsheet_id,creds)
-    if(len(credit_transactions) != 0):
-        credit_range = csv_list_to_sheet('Credit',credit_transactions,spreadsheet_id,creds)
-        #pass
+    # Statements overlapping each other keep one copy of their shared transactions
+    with profiler.stage('merge',rows):
+        frames = union_transactions(frames)
 
-    return (debit_range,credit_range)
+    return concat_transactions(frames)
 
+def write_new_transactions(transactions,spreadsheet_id,session,mirror,concurrent=True,balance_mode=BALANCE_MODE,profiler=None,dry_run=False,result=None,backend=None):
+    """
+    Add transactions not yet in a spreadsheet's ledgers, with balance and category, in one request
+    Args:   transactions: normalized transactions frame in ASC order by date
+            spreadsheet_id: spreadsheet id of google spreadsheet to update
+            session: client session for google account
+            mirror: local mirror of the ledger sheets
+            concurrent: run the Debit and Credit pipelines concurrently
+            balance_mode: values/array_formula, see BALANCE_MODE
+            profiler: RunProfiler timing each stage (optional)
+            dry_run: plan the new rows without writing them (ledger transactions get Balance/Category columns)
+            result: IngestResult of transactions already deduplicated while streaming (optional)
+            backend: SheetsBackend/OutboxBackend rows are written to (default writes to google sheets right away)
+    Return: IngestResult with range of rows added (or to be added) and error of each ledger
+    """
+    profiler = profiler or RunProfiler()
+    deduplicated = result is not None
+    result = result or IngestResult()
+
+    # split master frame into debit/credit transactions
+    for ledger_result in result:
+        ledger_result.transactions = transactions[transactions['Ledger'] == ledger_result.ledger]
+
+    def deduplicate(ledger_result):
+        # Edit ledger transactions to contain only new data
+        if len(ledger_result.transactions) != 0:
+            with profiler.stage('dedup[' + ledger_result.ledger + ']',len(ledger_result.transactions)):
+                ledger_result.transactions = compare_sheet_data_to_csv_data(ledger_result.ledger,ledger_result.transactions,spreadsheet_id,session,mirror)
+
+    if not deduplicated:
+        run_ledger_pipelines(deduplicate,result,concurrent)
+
+    # Balances left stale by rows synced from the sheet go out with this write, a dry run leaves sheet and mirror as they are
+    if not dry_run:
+        for ledger_result in result:
+            key = balance_rebase_key(spreadsheet_id,ledger_result.ledger)
+            if ledger_result.error is None and mirror.get_meta(key):
+                rebase_balances(ledger_result.ledger,spreadsheet_id,session,mirror)
+                mirror.delete_meta(key)
+
+    # Existing categories, shared by both ledgers
+    category_index = mirror.category_index
+
+    # Plan final rows of both ledgers, then write them in one request (with rebased balances, if any)
+    planned = [ledger_result for ledger_result in result if ledger_result.error is None and len(ledger_result.transactions) != 0]
+    plans = [plan_ledger_write(ledger_result.ledger,ledger_result.transactions,spreadsheet_id,mirror,category_index,balance_mode,profiler) for ledger_result in planned]
+
+    # Nothing is written, report where rows would land
+    if dry_run:
+        for (ledger_result, plan) in zip(planned, plans):
+            ledger_result.transactions = plan['transactions']
+            ledger_result.updated_range = plan['range']
+        return result
+
+    # Summary sheet from aggregates updated with the new rows, written with them
+    if plans:
+        with profiler.stage('summary'):
+            summary_rows = queue_summary(spreadsheet_id,session,mirror,plans)
+
+    try:
+        with profiler.stage('write',sum(len(plan['values']) for plan in plans)):
+            updated_ranges = commit_write_plans(plans,spreadsheet_id,session,mirror,backend)
+    except Exception as error:
+        # Single request, every ledger with queued updates failed
+        for ledger_result in (planned or [ledger_result for ledger_result in result if ledger_result.error is None]):
+            ledger_result.error = error
+        # Rebased balances were mirrored but never written, read the ledgers again next run
+        for ledger_result in result:
+            mirror.expire_sync(spreadsheet_id,ledger_result.ledger)
+    else:
+        for (ledger_result, updated_range) in zip(planned, updated_ranges):
+            ledger_result.updated_range = updated_range
+        if plans:
+            mirror.set_meta(summary_rows_key(spreadsheet_id),str(summary_rows))
+
+    return result
+
+# Cut string after first special character except (,.'*&/)
+# Cut string after patterns with letters&numbers i.e. xxx478, F1567, 12AM
+# if string starts with non letter, keep first pattern
+USEFUL_STRING_REGEX = r"[^-\w.,'*&/# ]|, | [a-zA-Z]*\d| #\d*| \d+"
+USEFUL_STRING_PATTERN = re.compile(USEFUL_STRING_REGEX, re.I)
+# PSCU specific: cut string at "CO:" (ACH company field)
+PSCU_COMPANY_PATTERN = re.compile(r'\s*CO:.*', re.S)
+# PSCU specific: keep "ZEL *" plus the 2 words after it
+PSCU_ZELLE_PATTERN = re.compile(r'^(ZEL \*\s*\S+(?:\s+\S+)?)')
+# Exceptions: merchants kept as is (would otherwise be cut at their digits)
+USEFUL_STRING_EXCEPTIONS = ['BIG 5 SPORTING GOODS', 'To Share 00']
+# Max number of raw descriptions remembered by extract_useful_string
+USEFUL_STRING_CACHE_SIZE = 4096
+
+@functools.lru_cache(maxsize=USEFUL_STRING_CACHE_SIZE)
 def extract_useful_string(transaction):
-    # Cut string after first special character except (,.'*&/)
-    # Cut string after patterns with letters&numbers i.e. xxx478, F1567, 12AM
-    # if string starts with non letter, keep first pattern
-    # PSCU specific: cut string after "CO:", ZEL *(KEEP 2 WORDS AFTER)
-    # Exceptions: BIG 5 SPORTING GOODS, To Share 00 WORDS
+    """
+    Normalize a raw transaction description to its merchant name
+    Results are memoized, see extract_useful_string.cache_info() for hit/miss counts
+    Args:   transaction: raw transaction description
+    Return: normalized description
+    """
+    # Exceptions are returned up to the end of the exception
+    for exception in USEFUL_STRING_EXCEPTIONS:
+        if transaction.upper().startswith(exception.upper()):
+            return transaction[:len(exception)]
 
-    # Regular expression to match above criteria
-    pattern = re.compile(r'([^-\w.,\'*&/# ]|, | [a-zA-Z]*\d| #\d*| \d+)', re.I)
+    # Zelle payments keep the name of who was paid
+    zelle = PSCU_ZELLE_PATTERN.match(transaction)
+    if zelle:
+        return zelle.group(1)
+
+    # Drop ACH company field
+    transaction = PSCU_COMPANY_PATTERN.sub('', transaction)
 
     # Finds the matches of above pattern in each transaction
-    matches = pattern.search(transaction)
+    matches = USEFUL_STRING_PATTERN.search(transaction)
 
     # Return full transaction name if match not found
     if matches == None:
@@ -334,251 +1802,895 @@ def extract_useful_string(transaction):
 
     # Return the string up to the first match
     return transaction[:matches.span()[0]]
-    
-def update_balance_column(updated_range,spreadsheet_id,creds):
+
+def normalize_descriptions(descriptions):
     """
-    Update the balance column of newly appended transactions
-    Args:   updated_range: range of newly appended transactions
-            creds: credentials to perform api call
-    Return: None
+    extract_useful_string for a whole Series of descriptions
+    Each distinct description is normalized only once, through the memoized extract_useful_string
+    Args:   descriptions: Series of raw transaction descriptions
+    Return: categorical Series of normalized descriptions, same index
     """
-    (debit_range,credit_range) = updated_range
-
-    # Nothing to be updated
-    if not (debit_range or credit_range):
-        return
+    # Normalize distinct descriptions only (merchant strings repeat a lot), memoized across chunks and watch batches
+    codes, uniques = pandas.factorize(descriptions.astype(str))
+    normalized = [extract_useful_string(description) for description in uniques]
 
-    debit_balance_values = []
-    credit_balance_values = []
-
-    service = build('sheets','v4',credentials=creds)
-
-    # If debit sheet updated, get range for debit sheet to be updated
-    if debit_range:
-        debit_range = debit_range.replace("A","E")
-        debit_range = debit_range.replace(":D",":E")
-        debit_range_values = re.findall("\d+",debit_range)
-        # Generate list of formulas to be applied to sheet
-        for i in range(int(debit_range_values[0]),int(debit_range_values[1])+1):
-            debit_balance_values.append('=E'+str(i-1)+'+D'+str(i))
-
-    # If credit sheet updated, get range for credit sheet to be updated
-    if credit_range:
-        credit_range = credit_range.replace("A","E")
-        credit_range = credit_range.replace(":D",":E")
-        credit_range_values = re.findall("\d+",credit_range)
-        for i in range(int(credit_range_values[0]),int(credit_range_values[1])+1):
-            credit_balance_values.append('=E'+str(i-1)+'+D'+str(i))
-
-    # Determine request body data depending on data updated
-    if debit_range and credit_range:
-        data = [
-            {
-                'range':debit_range,
-                'majorDimension':'COLUMNS',
-                'values':[debit_balance_values]
-            },
-            {
-                'range':credit_range,
-                'majorDimension':'COLUMNS',
-                'values':[credit_balance_values]
-            }
-        ]
-    elif debit_range:
-        data = [
-            {
-                'range':debit_range,
-                'majorDimension':'COLUMNS',
-                'values':[debit_balance_values]
-            }
-        ]
-    elif credit_range:
-        data = [
-            {
-                'range':credit_range,
-                'majorDimension':'COLUMNS',
-                'values':[credit_balance_values]
-            }
-        ]
-    # Request body
-    batch_update_values_request_body = {
-        # How the data should be interprested
-        'value_input_option': 'USER_ENTERED',
-        'data': data
-    }
+    # Expand distinct results back to every row, each merchant stored once
+    (merchant_codes, merchants) = pandas.factorize(pandas.Series(normalized, dtype=object))
+    return pandas.Series(pandas.Categorical.from_codes(merchant_codes[codes], categories=merchants), index=descriptions.index)
 
-    # Calling spreadsheets.values.batchUpdate api
-    request = service.spreadsheets().values().batchUpdate(spreadsheetId=spreadsheet_id, body=batch_update_values_request_body)
-    response = request.execute()
+def running_balances(cents,checkpoint=0.0):
+    """
+    Vectorized running balance of amounts, continuing from a checkpoint balance
+    Sums are done in whole cents so balances never drift
+    Args:   cents: sequence of amounts in whole cents
+            checkpoint: balance before the first amount, in dollars
+    Return: numpy array of running balances, in dollars
+    """
+    return (int(round(checkpoint * 100)) + numpy.cumsum(numpy.asarray(cents, dtype='int64'))) / 100
 
-def categorize(updated_range,spreadsheet_id,creds):
+def update_balance_column(trans_type,transactions,first_row,spreadsheet_id,mirror,balance_mode=BALANCE_MODE):
     """
-    Add a category to all new transactions added based off of categories for previous transacations
-    Args:   updated_range: range of new transactions to add categories to
+    Compute the balance column of new transactions, continuing from the row above
+    Args:   trans_type: Debit/Credit
+            transactions: frame of new transactions
+            first_row: sheet row of first transaction
             spreadsheet_id: id of spreadsheet to be updated
-            creds: credentials to perform api call
-    Return: None
+            mirror: local mirror of the ledger sheets
+            balance_mode: values/array_formula, see BALANCE_MODE
+    Return: Tuple of (list of running balances, list of balance cells for the sheet)
     """
-    # Setting debit/credit range to batch get
-    (debit_range,credit_range) = updated_range
+    # Running balance continues from the checkpoint of the mirrored row above
+    checkpoint = mirror.balance_before(spreadsheet_id,trans_type,first_row)
+    balances = running_balances(transactions['Cents'].to_numpy(),checkpoint).tolist()
 
-    # Nothing to be updated
-    if not (debit_range or credit_range):
-        return
+    # Plain values, or nothing when the array formula computes the column (None cells are skipped by the api)
+    if balance_mode == 'array_formula':
+        balance_cells = [None] * len(balances)
+    else:
+        balance_cells = balances
 
-    if debit_range:
-        debit_range_values = re.findall('\d+',debit_range)
-        debit_range = 'Debit!A2:F' + debit_range_values[1]
-        debit_categories = []
-        ranges = [debit_range]
-
-    if credit_range:
-        credit_range_values = re.findall('\d+',credit_range)
-        credit_range = 'Credit!A2:F' + credit_range_values[1]
-        credit_categories = []
-        ranges = [credit_range]
-
-    if debit_range and credit_range:
-        ranges = [debit_range,credit_range]
-    
-    
-    # Create dictionary
-    categories = {}
+    return (balances, balance_cells)
 
-    # Define sheets service
-    service = build('sheets', 'v4', credentials=creds)
-    # Value retrieves amount as number
-    value_render_option = 'FORMULA'
-    # Value retrieves date as serial number (days since 12/30/1899 as integer)
-    date_time_render_option = 'SERIAL_NUMBER'
+def rebase_balances(trans_type,spreadsheet_id,session,mirror):
+    """
+    Rewrite plain balance values of a ledger from the first row whose balance does not follow from the rows above
+    (i.e. rows inserted out of order or amounts edited by hand), queueing the update with the session's scheduler
+    The first row's balance is kept as the ledger's opening balance
+    Args:   trans_type: Debit/Credit
+            spreadsheet_id: id of spreadsheet to be updated
+            session: client session to perform api call
+            mirror: local mirror of the ledger sheets
+    Return: range queued for update, None if balances are consistent
+    """
+    # Array formula keeps balances consistent by itself
+    if mirror.get_meta(balance_formula_key(spreadsheet_id,trans_type)):
+        return None
 
-    major_dimension = 'ROWS'
+    rows = mirror.balance_rows(spreadsheet_id,trans_type)
+    if not rows:
+        return None
+    (row_numbers, amounts, stored) = zip(*rows)
+    stored = numpy.array([numpy.nan if balance is None else balance for balance in stored])
 
-    # Calling spreadsheets.values.get api
-    request = service.spreadsheets().values().batchGet(spreadsheetId=spreadsheet_id,ranges=ranges,valueRenderOption=value_render_option, dateTimeRenderOption=date_time_render_option, majorDimension=major_dimension)
-    response = request.execute()
+    # Opening balance of the ledger, first amount when blank
+    opening = stored[0] if not numpy.isnan(stored[0]) else amounts[0]
+    expected = numpy.concatenate(([opening], running_balances(to_cents(amounts[1:]),opening)))
 
-    # Populate dictionary with existing categories
-    for values in response['valueRanges']:
-        for value in values['values']:
-            try:
-                categories[value[0]] = value[5]
-            except IndexError:
-                pass
-
-    # Resetting debit/credit range to update range to batch update
-    (debit_range,credit_range) = updated_range
-
-    # Update newest data category column
-    if debit_range and credit_range:
-        # Update range to batch update (Column F = Categories column)
-        debit_range = debit_range.replace("A","F")
-        debit_range = debit_range.replace(":D",":F")
-        credit_range = credit_range.replace("A","F")
-        credit_range = credit_range.replace(":D",":F")
-
-        # Update category list values of newly appended debit transactions
-        for value in response['valueRanges'][0]['values'][-(int(debit_range_values[1])-int(debit_range_values[0]))-1:]:
-            # Update list to corresponding transaction category if it exists
-            if(value[0] in categories):
-                debit_categories.append(categories[value[0]])
-            else:
-                debit_categories.append('')
+    # First row whose balance is off (blank balances included)
+    mismatched = ~numpy.isclose(stored, expected, rtol=0, atol=0.005)
+    if not mismatched.any():
+        return None
+    start = int(numpy.argmax(mismatched))
+
+    # One contiguous range from that row down, rows without an amount are left untouched
+    rebased = dict(zip(row_numbers[start:], expected[start:].tolist()))
+    (first_row, last_row) = (row_numbers[start], row_numbers[-1])
+    balance_range = trans_type + '!E' + str(first_row) + ':E' + str(last_row)
+    session.scheduler.queue_update(spreadsheet_id, [{
+        'range':balance_range,
+        'majorDimension':'COLUMNS',
+        'values':[[rebased.get(row) for row in range(first_row,last_row+1)]]
+    }],'RAW')
+    mirror.set_balances(spreadsheet_id,trans_type,rebased.items())
+    return balance_range
+
+def balance_rebase_key(spreadsheet_id,trans_type):
+    # Mirror meta key set when a ledger was synced and its balances have to be checked before the next write
+    return 'rebase:' + spreadsheet_id + ':' + trans_type
+
+def balance_formula_key(spreadsheet_id,trans_type):
+    # Mirror meta key set once the balance array formula is installed in a ledger
+    return 'balance_formula:' + spreadsheet_id + ':' + trans_type
+
+def categorize(transactions,category_index):
+    """
+    Find a category for new transactions based off of categories for previous transacations
+    Args:   transactions: frame of new transactions
+            category_index: CategoryIndex of previous transactions
+    Return: list of categories ('' if none found)
+    """
+    # Look up each distinct description once
+    categories = {description: category_index.lookup(description)[0] for description in transactions['Description'].unique()}
+    # Update list to corresponding transaction category if it exists
+    return [categories[description] for description in transactions['Description']]
 
-        # Update category list values of newly appended credit transactions
-        for value in response['valueRanges'][1]['values'][-(int(credit_range_values[1])-int(credit_range_values[0]))-1:]:
-            if(value[0] in categories):
-                credit_categories.append(categories[value[0]])
-            else:
-                credit_categories.append('')
-
-        # Update data to send to batch update API
-        data = [
-            {
-                'range':debit_range,
-                'majorDimension':'COLUMNS',
-                'values':[debit_categories]
-            },
-            {
-                'range':credit_range,
-                'majorDimension':'COLUMNS',
-                'values':[credit_categories]
-            }
-        ]
-
-    elif debit_range:
-        # Update range to batch update (Column F = Categories column)
-        debit_range = debit_range.replace("A","F")
-        debit_range = debit_range.replace(":D",":F")
-        
-        # Update category list values of newly appended debit transactions
-        for value in response['valueRanges'][0]['values'][-(int(debit_range_values[1])-int(debit_range_values[0]))-1:]:
-            if(value[0] in categories):
-                debit_categories.append(categories[value[0]])
-            else:
-                debit_categories.append('')
+def plan_ledger_write(trans_type,transactions,spreadsheet_id,mirror,category_index,balance_mode=BALANCE_MODE,profiler=None):
+    """
+    Compute the final sheet rows (A:F) of new transactions, placed right after the ledger's last mirrored row
+    Args:   trans_type: Debit/Credit
+            transactions: frame of new transactions
+            spreadsheet_id: id of spreadsheet to be updated
+            mirror: local mirror of the ledger sheets
+            category_index: CategoryIndex of previous transactions
+            balance_mode: values/array_formula, see BALANCE_MODE
+            profiler: RunProfiler timing the balance and categorize stages (optional)
+    Return: write plan dict (ledger, first_row, range, values, transactions with Balance/Category, aggregates, balance_mode)
+    """
+    profiler = profiler or RunProfiler()
+    first_row = mirror.last_row(spreadsheet_id,trans_type) + 1
+    last_row = first_row + len(transactions) - 1
+
+    with profiler.stage('balance[' + trans_type + ']',len(transactions)):
+        (balances, balance_cells) = update_balance_column(trans_type,transactions,first_row,spreadsheet_id,mirror,balance_mode)
+    with profiler.stage('categorize[' + trans_type + ']',len(transactions)):
+        categories = categorize(transactions,category_index)
+    transactions = transactions.assign(Balance=balances, Category=categories)
+    with profiler.stage('analytics[' + trans_type + ']',len(transactions)):
+        aggregates = monthly_aggregates(transactions)
+
+    # Sheet rows: description, notes, date, amount (A:D), balance (E), category (F)
+    values = [[description, '', date_serial, amount, balance_cell, category] for (description, date_serial, amount, balance_cell, category)
+        in zip(transactions['Description'].tolist(), transactions['Date'].tolist(), (transactions['Cents'] / 100).tolist(), balance_cells, categories)]
+
+    return {
+        'ledger': trans_type,
+        'first_row': first_row,
+        'range': trans_type + '!A' + str(first_row) + ':F' + str(last_row),
+        'values': values,
+        'transactions': transactions,
+        'aggregates': aggregates,
+        'balance_mode': balance_mode,
+    }
 
-        data = [
-            {
-                'range':debit_range,
-                'majorDimension':'COLUMNS',
-                'values':[debit_categories]
-            }
-        ]
-
-    elif credit_range:
-        # Update range to batch update (Column F = Categories column)
-        credit_range = credit_range.replace("A","F")
-        credit_range = credit_range.replace(":D",":F")
-        
-        # Update category list values of newly appended credit transactions
-        for value in response['valueRanges'][0]['values'][-(int(credit_range_values[1])-int(credit_range_values[0]))-1:]:
-            if(value[0] in categories):
-                credit_categories.append(categories[value[0]])
-            else:
-                credit_categories.append('')
+def monthly_aggregates(transactions):
+    """
+    Spend of transactions per month: in total, per category and per merchant
+    Args:   transactions: frame of transactions with Category column
+    Return: list of (month YYYY-MM, group, name, cents, count), see SUMMARY_GROUPS
+    """
+    if len(transactions) == 0:
+        return []
+    frame = pandas.DataFrame({
+        'Month': serial_months(transactions['Date']),
+        'Total': '',
+        'Category': transactions['Category'].fillna('').astype(str).replace('', SUMMARY_UNCATEGORIZED).to_numpy(),
+        'Description': transactions['Description'].astype(str).to_numpy(),
+        'Cents': transactions['Cents'].to_numpy(),
+    })
+
+    aggregates = []
+    for (group, column) in SUMMARY_GROUPS.items():
+        # Sum and count of amounts of each month/name
+        totals = frame.groupby(['Month', column or 'Total'], sort=False)['Cents'].agg(['sum', 'count'])
+        aggregates.extend((month, group, name, int(cents), int(count)) for ((month, name), cents, count) in zip(totals.index, totals['sum'], totals['count']))
+    return aggregates
+
+def rebuild_aggregates(trans_type,spreadsheet_id,mirror):
+    """
+    Recompute a ledger's stored aggregates from every mirrored row
+    Args:   trans_type: Debit/Credit
+            spreadsheet_id: google spreadsheet id
+            mirror: local mirror of the ledger sheets
+    Return: None
+    """
+    rows = mirror.ledger_transactions(spreadsheet_id,trans_type)
+    (descriptions, dates, amounts, categories) = zip(*rows) if rows else ((), (), (), ())
+    transactions = pandas.DataFrame({
+        'Description': list(descriptions),
+        'Date': numpy.asarray(dates, dtype='int64'),
+        'Cents': to_cents(amounts),
+        'Category': list(categories),
+    })
+    mirror.add_aggregates(spreadsheet_id,trans_type,monthly_aggregates(transactions),replace=True)
+
+def queue_summary(spreadsheet_id,session,mirror,plans):
+    """
+    Queue a rewrite of the summary sheet of a spreadsheet, from its stored aggregates plus those of the planned rows,
+    so it goes out in the same request (or outbox entry) as the rows
+    Values are written RAW so months stay YYYY-MM text, a missing summary sheet is added when the write is sent (see write_values)
+    Args:   spreadsheet_id: id of spreadsheet to be updated
+            session: client session for google account
+            mirror: local mirror holding the aggregates
+            plans: list of write plans from plan_ledger_write
+    Return: number of summary rows written, blank rows left over from a longer summary included
+    """
+    # (month, ledger, group, name) -> [cents, count]
+    totals = {}
+    for (month, ledger, group, name, cents, count) in mirror.aggregates(spreadsheet_id):
+        totals[(month, ledger, group, name)] = [cents, count]
+    for plan in plans:
+        for (month, group, name, cents, count) in plan.get('aggregates', []):
+            total = totals.setdefault((month, plan['ledger'], group, name), [0, 0])
+            total[0] += cents
+            total[1] += count
+
+    # By month, ledger, group then largest amount
+    groups = list(SUMMARY_GROUPS)
+    keys = sorted(totals, key=lambda key: (key[0], key[1], groups.index(key[2]), -abs(totals[key][0]), key[3]))
+    values = [list(SUMMARY_HEADER)] + [list(key) + [totals[key][0] / 100, totals[key][1]] for key in keys]
+    # Blank rows left over from a longer summary
+    previous = int(mirror.get_meta(summary_rows_key(spreadsheet_id)) or 0)
+    values.extend([[''] * len(SUMMARY_HEADER)] * (previous - len(values)))
+
+    session.scheduler.queue_update(spreadsheet_id,[{'range':SUMMARY_SHEET + '!A1:F' + str(len(values)), 'majorDimension':'ROWS', 'values':values}],'RAW')
+    return len(values)
+
+def summary_rows_key(spreadsheet_id):
+    # Mirror meta key holding the number of rows of a spreadsheet's summary sheet
+    return 'summary_rows:' + spreadsheet_id
+
+def write_values(session,spreadsheet_id,data,value_input_option='USER_ENTERED'):
+    """
+    Write value ranges to a spreadsheet in one batchUpdate, adding the summary sheet first if it is missing
+    Args:   session: client session for google account
+            spreadsheet_id: id of spreadsheet to be updated
+            data: list of value ranges (range, majorDimension, values)
+            value_input_option: how the values should be interpreted
+    Return: list of update responses, in data order
+    """
+    from googleapiclient.errors import HttpError
+    try:
+        return session.scheduler.write_values(session.sheets,spreadsheet_id,data,value_input_option)
+    except HttpError as error:
+        # Summary sheet not there yet (or deleted by hand), ledger sheets are never added
+        missing = error.resp.status == 400 and 'Unable to parse range: ' + SUMMARY_SHEET + '!' in error.content.decode('utf-8', 'replace')
+        if not missing:
+            raise
+    add_sheet(session,spreadsheet_id,SUMMARY_SHEET)
+    return session.scheduler.write_values(session.sheets,spreadsheet_id,data,value_input_option)
+
+def add_sheet(session,spreadsheet_id,title):
+    """
+    Add a sheet (tab) to a spreadsheet
+    Args:   session: client session for google account
+            spreadsheet_id: id of spreadsheet to be updated
+            title: sheet title
+    Return: sheet id
+    """
+    # Calling spreadsheets.batchUpdate api
+    request = session.sheets.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={'requests': [{'addSheet': {'properties': {'title': title}}}]})
+    response = session.execute(request)
+    return response['replies'][0]['addSheet']['properties']['sheetId']
 
-        data = [
-            {
-                'range':credit_range,
-                'majorDimension':'COLUMNS',
-                'values':[credit_categories]
-            }
-        ]
+class SheetsBackend:
+    """
+    Ledger storage writing updates straight to google sheets
+    Args:   session: client session for google account
+    """
+    # Writes need google, reads of the same run keep retrying until it answers
+    offline = False
+
+    def __init__(self,session):
+        self.session = session
+
+    def write(self,spreadsheet_id,batches,guards=()):
+        """
+        Write value updates of a spreadsheet
+        Guards are not checked again: rows are planned against the sheet's tail, checked by the same run's mirror sync
+        Args:   spreadsheet_id: id of spreadsheet to be updated
+                batches: list of (value input option, list of value ranges)
+                guards: guards of the ledger rows written, see commit_write_plans
+        Return: dict of value input option -> list of update responses, in data order
+        """
+        return {value_input_option: write_values(self.session,spreadsheet_id,data,value_input_option) for (value_input_option, data) in batches}
+
+class OutboxBackend:
+    """
+    Write-behind ledger storage: updates are committed to a durable outbox in the local mirror and replayed later by replay_outbox
+    Every update writes fixed ranges, so replaying an entry twice (i.e. after a crash) leaves the sheet the same
+    Args:   mirror: local mirror of the ledger sheets
+    """
+    # Writes never need google, reads of the same run fail fast (see RequestScheduler.failing_fast)
+    offline = True
+
+    def __init__(self,mirror):
+        self.mirror = mirror
+
+    def write(self,spreadsheet_id,batches,guards=()):
+        """
+        Queue value updates of a spreadsheet, without any api call
+        Args:   spreadsheet_id: id of spreadsheet to be updated
+                batches: list of (value input option, list of value ranges)
+                guards: guards of the ledger rows written, checked when the update is replayed (see commit_write_plans)
+        Return: dict of value input option -> list of responses with the range each update will land in
+        """
+        for (value_input_option, data) in batches:
+            ranges = {value_range['range'] for value_range in data}
+            self.mirror.enqueue_outbox(spreadsheet_id,value_input_option,data,[guard for guard in guards if guard['range'] in ranges])
+        return {value_input_option: [{'updatedRange': value_range['range']} for value_range in data] for (value_input_option, data) in batches}
+
+def replay_outbox(session,mirror):
+    """
+    Send updates queued by OutboxBackend to google sheets, oldest first, removing each once written
+    Ledger rows whose guard fails (rows were added to the sheet since they were queued) are appended below the sheet's last row instead
+    of overwriting it, and the ledger's mirror is read whole on next sync
+    Stops at the first transient failure (rate limited or google unreachable) so updates always land in order
+    An update failing for good (i.e. spreadsheet deleted, tab renamed, access revoked) is set aside with every later update of its spreadsheet,
+    listed by status: the spreadsheet is looked up and read again on next run, other spreadsheets are still updated
+    Args:   session: client session for google account
+            mirror: local mirror holding the outbox
+    Return: number of updates sent
+    """
+    sent = 0
+    # spreadsheet id -> id of its failed update
+    failed = {}
+    # Updates stay queued, a later replay sends them once google is reachable
+    with session.scheduler.failing_fast():
+        for entry in mirror.outbox_entries():
+            sent += replay_outbox_entry(session,mirror,entry,failed)
+
+    # Mirror holds rows that never landed, cached ids may be stale
+    for spreadsheet_id in failed:
+        SpreadsheetResolver(session,mirror).forget(spreadsheet_id)
+        for ledger in LEDGERS:
+            mirror.expire_sync(spreadsheet_id,ledger)
+    return sent
+
+def replay_outbox_entry(session,mirror,entry,failed):
+    """
+    Send one queued update, see replay_outbox
+    Args:   session: client session for google account
+            mirror: local mirror holding the outbox
+            entry: (id, spreadsheet id, value input option, value ranges, guards) from outbox_entries
+            failed: dict of spreadsheet id -> id of its failed update, updated when this one fails for good
+    Return: 1 if the update was sent, else 0
+    """
+    from googleapiclient.errors import HttpError
+    (entry_id, spreadsheet_id, value_input_option, data, guards) = entry
+    # Later updates would land out of order (i.e. rows planned after the failed ones)
+    if spreadsheet_id in failed:
+        mirror.fail_outbox(entry_id,'Follows failed update #' + str(failed[spreadsheet_id]))
+        return 0
+
+    try:
+        (data, appends, moved) = check_outbox_guards(session,spreadsheet_id,data,guards)
+        if data:
+            write_values(session,spreadsheet_id,data,value_input_option)
+        for value_range in appends:
+            append_ledger_rows(session,spreadsheet_id,value_range,value_input_option)
+    except HttpError as error:
+        if is_transient_error(error):
+            raise
+        print('Update #' + str(entry_id) + ' of ' + spreadsheet_id + ' set aside: ' + repr(error))
+        mirror.fail_outbox(entry_id,repr(error))
+        failed[spreadsheet_id] = entry_id
+        return 0
+
+    for ledger in moved:
+        mirror.expire_sync(spreadsheet_id,ledger)
+    mirror.delete_outbox(entry_id)
+    return 1
+
+def check_outbox_guards(session,spreadsheet_id,data,guards):
+    """
+    Check that queued ledger rows still land right below the row they were planned after, with nothing written there yet
+    Rows written there by an earlier replay of the same update pass, so replaying stays idempotent
+    Args:   session: client session for google account
+            spreadsheet_id: id of spreadsheet to be updated
+            data: queued value ranges
+            guards: guards of the queued ledger rows, see commit_write_plans
+    Return: Tuple of (value ranges safe to write, ledger row ranges to append instead, ledgers whose rows moved)
+    """
+    if not guards:
+        return (data, [], [])
+
+    # Tail of every guarded ledger, from the row above the queued rows down, in one request
+    ranges = [guard['range'].split('!')[0] + '!A' + str(guard['first_row'] - 1) + ':F' for guard in guards]
+    request = session.sheets.spreadsheets().values().batchGet(spreadsheetId=spreadsheet_id,ranges=ranges,valueRenderOption='UNFORMATTED_VALUE',dateTimeRenderOption='SERIAL_NUMBER')
+    tails = [value_range.get('values', []) for value_range in session.execute(request).get('valueRanges', [])]
+
+    queued = {value_range['range']: value_range for value_range in data}
+    (appends, moved) = ([], [])
+    for (guard, tail) in zip(guards, tails):
+        rows = [row_fingerprint(row) for row in queued[guard['range']]['values']]
+        below = [row_fingerprint(row) for row in tail[1:]]
+        # Nothing below the anchor row, or these very rows (written by an earlier replay, maybe followed by later ones)
+        if row_fingerprint(tail[0] if tail else []) == guard['anchor'] and below[:len(rows)] in ([], rows):
+            continue
+        moved.append(guard['range'].split('!')[0])
+        # Rows already appended by an earlier replay
+        if Counter(rows) - Counter(row_fingerprint(row) for row in tail):
+            appends.append(queued[guard['range']])
 
-    # Request body
-    batch_update_values_request_body = {
-        # How the data should be interprested
-        'value_input_option': 'USER_ENTERED',
-        'data': data
-    }
+    # Other ranges of a moved ledger (i.e. rebased balances) are recomputed once it is read again
+    data = [value_range for value_range in data if value_range['range'].split('!')[0] not in moved]
+    return (data, appends, moved)
 
-    # Calling spreadsheets.values.batchUpdate api
-    request = service.spreadsheets().values().batchUpdate(spreadsheetId=spreadsheet_id, body=batch_update_values_request_body)
-    response = request.execute()
+def append_ledger_rows(session,spreadsheet_id,value_range,value_input_option='USER_ENTERED'):
+    """
+    Append rows below the last row of a ledger sheet, inserting rows so nothing is overwritten
+    Args:   session: client session for google account
+            spreadsheet_id: id of spreadsheet to be updated
+            value_range: value range of ledger rows (range, majorDimension, values)
+            value_input_option: how the values should be interpreted
+    Return: range where the rows landed
+    """
+    # Calling spreadsheets.values.append api
+    request = session.sheets.spreadsheets().values().append(spreadsheetId=spreadsheet_id,range=value_range['range'].split('!')[0] + '!A:F',
+        valueInputOption=value_input_option,insertDataOption='INSERT_ROWS',body={'values': value_range['values']})
+    return session.execute(request).get('updates', {}).get('updatedRange')
 
-def clean_old_csv_files():
-    os.system('find ~/Downloads/ -type f -mtime +5 -iname "*csv" -delete')
-    print('Cleaned csv files from ~/Downloads/ older than 5 days')
+def commit_write_plans(plans,spreadsheet_id,session,mirror,backend=None):
+    """
+    Write the planned rows of every ledger to google spreadsheet in a single batched request, then mirror them
+    Any other update queued for the spreadsheet (i.e. rebased balances, summary sheet) goes in the same request
+    Each plan's rows are guarded by the fingerprint of the mirrored row right above them, so a replayed update never overwrites
+    rows added to the sheet in the meantime (see replay_outbox)
+    Args:   plans: list of write plans from plan_ledger_write
+            spreadsheet_id: id of spreadsheet to be updated
+            session: client session to perform api call
+            mirror: local mirror of the ledger sheets
+            backend: SheetsBackend/OutboxBackend the request goes to (default writes to google sheets right away)
+    Return: list of ranges where each plan's rows landed
+    """
+    backend = backend or SheetsBackend(session)
+
+    # Install balance array formula once per ledger, clearing plain balances below it
+    formula_keys = []
+    for plan in plans:
+        key = balance_formula_key(spreadsheet_id,plan['ledger'])
+        if plan['balance_mode'] == 'array_formula' and not mirror.get_meta(key):
+            data = [{'range':plan['ledger'] + '!E2', 'values':[[BALANCE_ARRAY_FORMULA]]}]
+            if plan['first_row'] > 3:
+                data.append({'range':plan['ledger'] + '!E3:E' + str(plan['first_row'] - 1), 'majorDimension':'COLUMNS', 'values':[[''] * (plan['first_row'] - 3)]})
+            session.scheduler.queue_update(spreadsheet_id,data)
+            formula_keys.append(key)
+
+    # Queue planned rows, merged with any other update queued for the spreadsheet (plain values, written as they are)
+    positions = session.scheduler.queue_update(spreadsheet_id, [
+        {
+            'range':plan['range'],
+            'majorDimension':'ROWS',
+            'values':plan['values']
+        }
+        for plan in plans
+    ],'RAW')
+
+    # Row the rows of each plan are planned right after
+    guards = [{'range':plan['range'], 'first_row':plan['first_row'], 'anchor':mirror.row_fingerprint(spreadsheet_id,plan['ledger'],plan['first_row'] - 1)} for plan in plans]
+
+    # Calling spreadsheets.values.batchUpdate api (or queueing the request)
+    responses = backend.write(spreadsheet_id,session.scheduler.take_updates(spreadsheet_id),guards).get('RAW', [])
+
+    # Written rows are now part of the ledgers
+    for plan in plans:
+        mirror.add_rows(spreadsheet_id,plan['ledger'],plan['first_row'],plan['transactions'])
+        mirror.add_aggregates(spreadsheet_id,plan['ledger'],plan.get('aggregates', []))
+    for key in formula_keys:
+        mirror.set_meta(key,'1')
+
+    # Ranges reported by the api
+    return [responses[i].get('updatedRange', plan['range']) if i < len(responses) else plan['range'] for (i, plan) in zip(positions, plans)]
+
+def clean_old_csv_files(download_dir=DOWNLOAD_DIR,max_age=CSV_MAX_AGE):
+    """
+    Delete csv files in downloads folder older than max_age
+    Args:   download_dir: folder to clean
+            max_age: seconds since last modified before a file is deleted
+    Return: None
+    """
+    cutoff = time.time() - max_age
+    for entry in os.scandir(download_dir):
+        if entry.is_file() and entry.name.lower().endswith(".csv") and entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
+    print('Cleaned csv files from ' + download_dir + ' older than ' + str(max_age // (24 * 60 * 60)) + ' days')
 
 def open_google_sheet(spreadsheet_id):
     os.system('open -a /Applications/Safari.app https://docs.google.com/spreadsheets/d/'+spreadsheet_id+'/edit#gid=0')
 
-# MAIN PROGRAM
-def main():
+def ingest(session,mirror,manifest,download_dir=DOWNLOAD_DIR,profiler=None,input_files=None,dry_run=False,backend=None,workers=PARSE_WORKERS,chunksize=None):
+    """
+    Import new bank statements from downloads folder into the budget spreadsheet of each transaction's year
+    Streaming mode deduplicates each chunk of csv rows as it is read, against the spreadsheet of each year it has rows of
+    Args:   session: client session for google account
+            mirror: local mirror of the ledger sheets
+            manifest: manifest of csv files already ingested
+            download_dir: folder to import csv files from
+            profiler: RunProfiler timing each stage (optional)
+            input_files: new csv files already found in download_dir (optional)
+            dry_run: plan new rows without writing them or marking files as ingested
+            backend: SheetsBackend/OutboxBackend rows are written to (default writes to google sheets right away)
+            workers: number of processes parsing input files (whole files only)
+            chunksize: stream input files in chunks of this many rows (None reads whole files)
+    Return: list of (spreadsheet name, spreadsheet id, IngestResult), one per year in ASC order (id None if the year has no spreadsheet)
+    """
+    profiler = profiler or RunProfiler()
+    if input_files is None:
+        with profiler.stage('find_files') as stage:
+            input_files = get_csv_files(manifest,download_dir)
+            stage['rows'] = len(input_files)
+
+    # Spreadsheet ids are cached, so resolving costs no api call once a year's spreadsheet was found
+    resolver = SpreadsheetResolver(session,mirror)
+    # year -> (spreadsheet id, IngestResult) of years already deduplicated while streaming
+    streamed = {}
+
+    def sheet_index(ledger,year):
+        # Resolve and sync a year's spreadsheet the first time a streamed chunk has rows of it
+        if year not in streamed:
+            (spreadsheet_id, result) = resolve_spreadsheet(resolver,SPREADSHEET_NAME_FORMAT.format(year=year),profiler)
+            streamed[year] = (spreadsheet_id, result or IngestResult())
+        (spreadsheet_id, result) = streamed[year]
+        ledger_result = next(ledger_result for ledger_result in result if ledger_result.ledger == ledger)
+        # Rows of a year that can't be updated are kept as they are, its result already holds the error
+        if ledger_result.error is not None:
+            return Counter()
+        try:
+            with profiler.stage('sync[' + ledger + ']'):
+                sync_ledger_mirror(ledger,spreadsheet_id,session,mirror)
+        except Exception as error:
+            ledger_result.error = error
+            return Counter()
+        return mirror.fingerprint_index(spreadsheet_id,ledger)
+
+    results = []
+    # Rows committed to the outbox never wait on google: reads fall back to the mirror right away while it is unreachable
+    with session.scheduler.failing_fast(backend is not None and backend.offline):
+        if chunksize:
+            # Sync time of each year is included in the stream stage
+            with profiler.stage('stream') as stage:
+                transactions = concat_transactions(list(stream_new_transactions(input_files,sheet_index,chunksize)))
+                stage['rows'] = len(transactions)
+        else:
+            transactions = read_transactions(input_files,workers,profiler)
+
+        # Single pass over the run, an import spanning new year is split between both spreadsheets
+        for (year, year_transactions) in transactions.groupby(serial_years(transactions['Date']), sort=True):
+            name = SPREADSHEET_NAME_FORMAT.format(year=year)
+            if year in streamed:
+                (spreadsheet_id, result) = streamed[year]
+                if spreadsheet_id is not None:
+                    result = write_new_transactions(year_transactions,spreadsheet_id,session,mirror,profiler=profiler,dry_run=dry_run,result=result,backend=backend)
+            else:
+                (spreadsheet_id, result) = resolve_spreadsheet(resolver,name,profiler)
+
+            if result is None:
+                # Append new transactions with balance and category in one request
+                result = write_new_transactions(year_transactions,spreadsheet_id,session,mirror,profiler=profiler,dry_run=dry_run,backend=backend)
+                # Cached id no longer exists, look the spreadsheet up again and retry once
+                if any(is_not_found(error) for error in result.errors.values()):
+                    resolver.invalidate(name)
+                    (spreadsheet_id, found_result) = resolve_spreadsheet(resolver,name,profiler)
+                    if found_result is None:
+                        result = write_new_transactions(year_transactions,spreadsheet_id,session,mirror,profiler=profiler,dry_run=dry_run,backend=backend)
+
+            for (ledger, error) in result.errors.items():
+                print(name + ' ' + ledger + ' ledger not updated: ' + repr(error))
+            results.append((name, spreadsheet_id, result))
+
+    # Skip these files from now on, unless they have to be retried
+    if not any(result.errors for (name, spreadsheet_id, result) in results) and not dry_run:
+        manifest.mark_ingested()
+    return results
+
+def resolve_spreadsheet(resolver,name,profiler):
+    """
+    Find the spreadsheet of a year, turning a failed lookup into the year's result so other years are still imported
+    Args:   resolver: SpreadsheetResolver
+            name: spreadsheet name (i.e. 2021 Budget)
+            profiler: RunProfiler timing the lookup
+    Return: Tuple of (spreadsheet id, None), or (None, IngestResult with the error of both ledgers) if not found or google is unreachable
+    """
+    from googleapiclient.errors import HttpError
+    try:
+        with profiler.stage('resolve'):
+            spreadsheet_id = resolver.spreadsheet_id(name)
+        if spreadsheet_id is None:
+            raise LookupError('No spreadsheet named ' + name)
+    except (LookupError, HttpError, OSError, httplib2.HttpLib2Error) as error:
+        result = IngestResult()
+        for ledger_result in result:
+            ledger_result.error = error
+        return (None, result)
+    return (spreadsheet_id, None)
+
+def print_dry_run(results):
+    """
+    Print the rows a run would add to each ledger
+    Args:   results: list of (spreadsheet name, spreadsheet id, IngestResult) of a dry run
+    Return: None
+    """
+    if not results:
+        print('No new transactions')
+    for (name, spreadsheet_id, result) in results:
+        for ledger_result in result:
+            if ledger_result.error:
+                continue
+            if ledger_result.updated_range is None:
+                print(name + ' ' + ledger_result.ledger + ': no new transactions')
+                continue
+            print(name + ' ' + ledger_result.ledger + ': ' + str(len(ledger_result.transactions)) + ' new rows -> ' + ledger_result.updated_range)
+            transactions = ledger_result.transactions.assign(Amount=ledger_result.transactions['Cents'] / 100)
+            print(transactions[['Description','Date','Amount','Balance','Category']].to_string(index=False))
+
+def print_status(manifest,mirror,download_dir=DOWNLOAD_DIR):
+    """
+    Print csv files waiting to be ingested and the state of the local mirror, without any api call
+    Args:   manifest: manifest of csv files already ingested
+            mirror: local mirror of the ledger sheets
+            download_dir: folder csv files are imported from
+    Return: None
+    """
+    input_files = get_csv_files(manifest,download_dir)
+    print(str(len(input_files)) + ' new csv files in ' + download_dir)
+    for file in input_files:
+        print('  ' + os.path.basename(file))
+
+    ledgers = mirror.ledger_status()
+    if not ledgers:
+        print('Local mirror is empty, run ingest first')
+    for (spreadsheet_id, ledger, synced_at, rows, latest) in ledgers:
+        latest = (SERIAL_EPOCH + timedelta(days=latest)).strftime('%m/%d/%Y') if latest is not None else '-'
+        print(ledger + ' (' + spreadsheet_id + '): ' + str(rows) + ' rows, latest transaction ' + latest + ', synced ' + time.strftime('%m/%d/%Y %H:%M', time.localtime(synced_at)))
+    queued = mirror.outbox_count()
+    if queued:
+        print(str(queued) + ' updates queued for google sheets, sent on next ingest')
+    # Updates google sheets refused, their csv files have to be downloaded and ingested again
+    for (entry_id, spreadsheet_id, ranges, error, failed_at) in mirror.failed_outbox():
+        print('Update #' + str(entry_id) + ' of ' + spreadsheet_id + ' failed ' + time.strftime('%m/%d/%Y %H:%M', time.localtime(failed_at)) + ' (' + ', '.join(ranges) + '): ' + error)
+
+def send_outbox(session,mirror,profiler=None):
+    """
+    Replay queued updates to google sheets, keeping them queued if google is unreachable
+    Args:   session: client session for google account
+            mirror: local mirror holding the outbox
+            profiler: RunProfiler timing the replay, where rows reach google sheets (optional)
+    Return: True if the outbox is empty
+    """
+    profiler = profiler or RunProfiler()
+    try:
+        with profiler.stage('replay',mirror.outbox_count()):
+            replay_outbox(session,mirror)
+    except Exception as error:
+        print('Could not reach google sheets, ' + str(mirror.outbox_count()) + ' updates stay queued: ' + repr(error))
+        return False
+    return True
+
+def open_session():
+    """
+    Authenticate with the service account and open a client session
+    Args:   None
+    Return: SheetsSession
+    """
+    from oauth2client.service_account import ServiceAccountCredentials
     scope = [   "https://spreadsheets.google.com/feeds",
                 'https://www.googleapis.com/auth/spreadsheets',
                 "https://www.googleapis.com/auth/drive.file",
                 "https://www.googleapis.com/auth/drive"]
     creds = ServiceAccountCredentials.from_json_keyfile_name("/Users/joshuanavarro/Dropbox/PythonProjects/Budget_App/creds.json", scope)
-    clean_old_csv_files()
-    spreadsheet_id = get_spreadsheet_id(creds)
-    #sheet_id = get_sheet_id(creds,spreadsheet_id,'Debit')
-    input_files = get_csv_files()
-    updated_range = input_file_to_sheet(input_files,spreadsheet_id,creds)
-    update_balance_column(updated_range,spreadsheet_id,creds)
-    categorize(updated_range,spreadsheet_id,creds)
-    open_google_sheet(spreadsheet_id)
+    # One client session shared by every stage
+    return SheetsSession(creds)
+
+class InotifyWatcher:
+    """
+    Watch a folder for csv files written or moved into it with linux inotify
+    Only the names of changed files are reported, the folder is never scanned
+    Args:   directory: folder to watch
+    """
+    # inotify event masks (linux/inotify.h)
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_Q_OVERFLOW = 0x4000
+    # struct inotify_event header: wd, mask, cookie, len
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self,directory):
+        import ctypes
+        import ctypes.util
+        self.directory = directory
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, 'inotify_add_watch failed: ' + directory)
+
+    def wait(self,timeout):
+        """
+        Wait for csv files to change
+        Args:   timeout: max seconds to wait
+        Return: set of changed csv file paths, None if events were lost and the folder has to be scanned
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            # Kernel queue overflowed, changes were missed
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            if name.lower().endswith('.csv'):
+                changed.add(os.path.join(self.directory, name))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """
+    Watch a folder for changed csv files by comparing size/mtime between scans (used where inotify is not available)
+    Args:   directory: folder to watch
+    """
+    def __init__(self,directory):
+        self.directory = directory
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        # csv file path -> (size, mtime)
+        snapshot = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.lower().endswith('.csv'):
+                stat = entry.stat()
+                snapshot[entry.path] = (stat.st_size, stat.st_mtime)
+        return snapshot
+
+    def wait(self,timeout):
+        """
+        Wait for csv files to change
+        Args:   timeout: max seconds to wait
+        Return: set of changed csv file paths
+        """
+        time.sleep(min(timeout, WATCH_POLL_INTERVAL))
+        (previous, self.snapshot) = (self.snapshot, self._scan())
+        return {path for (path, entry) in self.snapshot.items() if previous.get(path) != entry}
+
+    def close(self):
+        pass
+
+def open_watcher(directory):
+    # inotify where available (linux), folder scans otherwise
+    try:
+        return InotifyWatcher(directory)
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher(directory)
+
+def watch(session,mirror,manifest,download_dir=DOWNLOAD_DIR,debounce=WATCH_DEBOUNCE,profiler=None,workers=PARSE_WORKERS,chunksize=None):
+    """
+    Ingest new bank statements as they land in the downloads folder, until interrupted
+    Files changing close together are ingested as one batch once all of them stopped changing for debounce seconds
+    Args:   session: client session for google account
+            mirror: local mirror of the ledger sheets
+            manifest: manifest of csv files already ingested
+            download_dir: folder to watch
+            debounce: seconds a file has to stay unchanged before it is ingested
+            profiler: RunProfiler timing each stage (optional)
+            workers: number of processes parsing input files, see ingest
+            chunksize: stream input files in chunks of this many rows, see ingest
+    Return: None
+    """
+    # Rows are written locally first, so a batch is never lost while offline
+    backend = OutboxBackend(mirror)
+    watcher = open_watcher(download_dir)
+    print('Watching ' + download_dir + ' (' + type(watcher).__name__ + '), press Ctrl+C to stop')
+    # Changed csv file path -> time of its last change
+    pending = {path: time.monotonic() for path in get_csv_files(manifest,download_dir)}
+    last_clean = time.monotonic()
+    last_replay = None
+    try:
+        while True:
+            changed = watcher.wait(debounce)
+            now = time.monotonic()
+            # Events were lost, fall back to one scan of the folder
+            if changed is None:
+                changed = set(get_csv_files(manifest,download_dir))
+            for path in changed:
+                pending[path] = now
+
+            # Updates queued while google was unreachable
+            if mirror.outbox_count() and (last_replay is None or now - last_replay > WATCH_REPLAY_INTERVAL):
+                send_outbox(session,mirror,profiler)
+                last_replay = now
+
+            # Old csv files are cleaned even when nothing is downloaded
+            if now - last_clean > WATCH_CLEAN_INTERVAL:
+                clean_old_csv_files(download_dir)
+                last_clean = now
+
+            # Batch is complete once nothing changed for debounce seconds
+            if not pending or now - max(pending.values()) < debounce:
+                continue
+            found = []
+            for path in pending:
+                try:
+                    found.append((path, os.stat(path)))
+                # File was renamed or removed before it settled
+                except FileNotFoundError:
+                    pass
+            pending = {}
+            input_files = new_csv_files(found,manifest)
+            if input_files:
+                print('Ingesting ' + ', '.join(os.path.basename(path) for path in input_files))
+                for (name, spreadsheet_id, result) in ingest(session,mirror,manifest,download_dir,profiler,input_files,backend=backend,workers=workers,chunksize=chunksize):
+                    for ledger_result in result:
+                        if ledger_result.updated_range:
+                            print(name + ': ' + ledger_result.updated_range)
+                send_outbox(session,mirror,profiler)
+                last_replay = time.monotonic()
+                # Files of a failed batch are retried once they change again or on next start
+                manifest.pending = {}
+    except KeyboardInterrupt:
+        print('Stopped watching ' + download_dir)
+    finally:
+        watcher.close()
+
+# MAIN PROGRAM
+def main():
+    parser = argparse.ArgumentParser(description='Import bank statements from Downloads into the budget spreadsheet')
+    parser.add_argument('--profile', metavar='REPORT', help='write stage timings, api calls and rows processed to a json file')
+    parser.add_argument('--profile-parse', metavar='STATS', help='dump cProfile stats of the parsing stage to a file')
+    parser.add_argument('--workers', type=int, default=PARSE_WORKERS, help='processes parsing csv files in parallel (default %(default)s)')
+    parser.add_argument('--chunk-size', type=int, metavar='ROWS', help='stream csv files this many rows at a time, keeping memory bounded (default reads whole files)')
+    commands = parser.add_subparsers(dest='command', metavar='{ingest,dry-run,status,watch}')
+    commands.add_parser('ingest', help='add new transactions to the budget spreadsheet (default)')
+    commands.add_parser('dry-run', help='show the rows new transactions would add, without writing anything')
+    commands.add_parser('status', help='show new csv files and the state of the local mirror, offline')
+    watch_parser = commands.add_parser('watch', help='keep running, adding new transactions as csv files are downloaded')
+    watch_parser.add_argument('--debounce', type=float, default=WATCH_DEBOUNCE, help='seconds a csv file has to stay unchanged before it is ingested')
+    args = parser.parse_args()
+    command = args.command or 'ingest'
+
+    # Manifest of csv files already ingested
+    manifest = IngestManifest()
+    if command == 'status':
+        print_status(manifest,LedgerMirror())
+        return
+
+    if command in ('ingest', 'watch'):
+        clean_old_csv_files()
+    if command == 'watch':
+        watch(open_session(),LedgerMirror(),manifest,debounce=args.debounce,workers=args.workers,chunksize=args.chunk_size)
+        return
+    # Local mirror of the ledger sheets
+    mirror = LedgerMirror()
+    # Stage timings, written as a json report with --profile
+    profiler = RunProfiler({'parse': args.profile_parse} if args.profile_parse else None)
+    # Nothing new or queued: exit before authenticating or loading pandas
+    with profiler.stage('find_files') as stage:
+        input_files = get_csv_files(manifest)
+        stage['rows'] = len(input_files)
+    if not input_files and not (command == 'ingest' and mirror.outbox_count()):
+        print('No new csv files in ' + DOWNLOAD_DIR)
+        return
+
+    session = open_session()
+    # New rows are committed to the local outbox, then replayed to google sheets
+    results = ingest(session,mirror,manifest,profiler=profiler,input_files=input_files,dry_run=command == 'dry-run',backend=OutboxBackend(mirror),
+        workers=args.workers,chunksize=args.chunk_size) if input_files else []
+    if command == 'ingest':
+        send_outbox(session,mirror,profiler)
+    if args.profile:
+        profiler.write_report(args.profile,session)
+        print('Profile written to ' + args.profile)
+
+    if command == 'dry-run':
+        print_dry_run(results)
+    else:
+        # Spreadsheet of the latest year updated
+        spreadsheet_ids = [spreadsheet_id for (name, spreadsheet_id, result) in results if spreadsheet_id]
+        if spreadsheet_ids:
+            open_google_sheet(spreadsheet_ids[-1])
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,43 @@
+# Shared fixtures: budget.py runs against the in-memory fake sheets/drive services of the benchmarks
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import budget
+from benchmarks.fake_sheets import FakeDrive, FakeSpreadsheet
+from benchmarks.synthetic import write_statement
+
+@pytest.fixture
+def spreadsheet():
+    return FakeSpreadsheet()
+
+@pytest.fixture
+def session(spreadsheet):
+    # No rate limits
+    session = budget.SheetsSession(None, sheets=spreadsheet, drive=FakeDrive())
+    session.scheduler.buckets = {bucket: budget.TokenBucket(1e9, 1e9) for bucket in session.scheduler.buckets}
+    return session
+
+@pytest.fixture
+def mirror():
+    return budget.LedgerMirror(':memory:')
+
+@pytest.fixture
+def manifest():
+    return budget.IngestManifest(':memory:')
+
+@pytest.fixture
+def statement(tmp_path):
+    """
+    Write a PSCU (Debit) export
+    Args:   name: csv file name
+            transactions: list of (date, description, amount) in ASC order by date
+    Return: csv file path
+    """
+    def write(name,transactions):
+        return write_statement('PSCU', str(tmp_path / name), transactions)
+    return write
@@ -0,0 +1,57 @@
+# Balances: plain balance values follow from the rows above, rebased when the sheet was edited by hand
+
+from datetime import date
+
+import budget
+
+def test_dry_run_leaves_stale_balances_to_the_next_run(session,spreadsheet,mirror,manifest,statement):
+    budget.ingest(session,mirror,manifest,input_files=[statement('a.csv', [(date(2021, 3, 1), 'GROCERY', -10.0), (date(2021, 3, 2), 'RENT', -20.0)])])
+    # Balance edited by hand, seen on next sync
+    debit = spreadsheet.workbooks['2021 Budget']['Debit']
+    debit[2][4] = 99.0
+    mirror.expire_sync('2021 Budget','Debit')
+    new_statement = statement('b.csv', [(date(2021, 3, 3), 'PHARMACY', -30.0)])
+
+    budget.ingest(session,mirror,manifest,input_files=[new_statement],dry_run=True)
+    assert debit[2][4] == 99.0
+    assert len(debit) == 3
+    # Nothing left queued for a later run (each run is its own process)
+    assert not session.scheduler.take_updates('2021 Budget')
+
+    budget.ingest(session,mirror,manifest,input_files=[new_statement])
+    assert [row[4] for row in debit[1:]] == [-10.0, -30.0, -60.0]
+
+def mirror_ledger(mirror,rows):
+    # Mirror Debit rows (amount, balance) of spreadsheet 'budget' from row 2 down
+    mirror.replace_ledger('budget','Debit',[['ROW ' + str(i), '', 44256, amount, balance, ''] for (i, (amount, balance)) in enumerate(rows)])
+
+def queued(session):
+    # Value ranges queued for spreadsheet 'budget'
+    return [value_range for (value_input_option, data) in session.scheduler.take_updates('budget') for value_range in data]
+
+def test_running_balances_continue_from_a_checkpoint_in_whole_cents():
+    assert budget.running_balances([10, 20, -5], 0.1).tolist() == [0.2, 0.4, 0.35]
+
+def test_consistent_balances_are_left_alone(session,mirror):
+    mirror_ledger(mirror, [(100.0, 100.0), (-10.0, 90.0), (-20.0, 70.0)])
+    assert budget.rebase_balances('Debit','budget',session,mirror) is None
+    assert not queued(session)
+
+def test_rebase_starts_at_the_first_wrong_balance(session,mirror):
+    # Amount of row 3 edited by hand, row 5 has no balance yet
+    mirror_ledger(mirror, [(100.0, 100.0), (-15.0, 90.0), (-20.0, 70.0), (-5.0, '')])
+
+    assert budget.rebase_balances('Debit','budget',session,mirror) == 'Debit!E3:E5'
+    assert queued(session) == [{'range': 'Debit!E3:E5', 'majorDimension': 'COLUMNS', 'values': [[85.0, 65.0, 60.0]]}]
+    # Mirror follows, so the next check finds nothing to do
+    assert budget.rebase_balances('Debit','budget',session,mirror) is None
+
+def test_opening_balance_is_kept(session,mirror):
+    mirror_ledger(mirror, [(-10.0, 500.0), (-10.0, 0.0)])
+    budget.rebase_balances('Debit','budget',session,mirror)
+    assert queued(session)[0]['values'] == [[490.0]]
+
+def test_array_formula_ledgers_are_never_rebased(session,mirror):
+    mirror_ledger(mirror, [(100.0, 100.0), (-10.0, 0.0)])
+    mirror.set_meta(budget.balance_formula_key('budget','Debit'),'1')
+    assert budget.rebase_balances('Debit','budget',session,mirror) is None
@@ -0,0 +1,43 @@
+# Category index: exact description, then merchant prefix, then shared tokens
+
+import budget
+
+def test_exact_description(mirror):
+    mirror.category_index.update([('STARBUCKS', 'Coffee')])
+    assert mirror.category_index.lookup('STARBUCKS') == ('Coffee', 1.0, 'exact')
+
+def test_merchant_prefix(mirror):
+    mirror.category_index.update([('STARBUCKS STORE 123', 'Coffee')])
+    (category, confidence, tier) = mirror.category_index.lookup('STARBUCKS STORE 99')
+    assert (category, tier) == ('Coffee', 'prefix')
+    assert budget.CATEGORY_MIN_CONFIDENCE <= confidence < 1.0
+
+def test_short_prefix_is_no_match(mirror):
+    mirror.category_index.update([('ABC', 'Fees')])
+    assert mirror.category_index.lookup('ABD') == ('', 0.0, None)
+
+def test_shared_tokens(mirror):
+    mirror.category_index.update([('AMAZON MARKETPLACE SEATTLE', 'Shopping')])
+    (category, confidence, tier) = mirror.category_index.lookup('SEATTLE AMAZON MARKETPLACE WA')
+    assert (category, tier) == ('Shopping', 'fuzzy')
+    assert confidence == 0.75
+
+def test_changed_category_replaces_the_old_one(mirror):
+    mirror.category_index.update([('STARBUCKS STORE 1', 'Coffee'), ('STARBUCKS STORE 2', 'Coffee')])
+    mirror.category_index.update([('STARBUCKS STORE 1', 'Food'), ('STARBUCKS STORE 2', 'Food')])
+    assert mirror.category_index.lookup('STARBUCKS STORE 3')[0] == 'Food'
+
+def test_index_persists_and_is_seeded_from_mirrored_rows(mirror):
+    mirror.replace_ledger('budget','Debit',[['TRADER JOE S', '', 44256, -10.0, '', 'Groceries']])
+    assert mirror.category_index.lookup('TRADER JOE S')[0] == 'Groceries'
+    mirror.category_index.update([('STARBUCKS', 'Coffee')])
+
+    # Loaded again from the mirror's database
+    index = budget.CategoryIndex(mirror)
+    assert (index.lookup('TRADER JOE S')[0], index.lookup('STARBUCKS')[0]) == ('Groceries', 'Coffee')
+
+def test_shared_rare_tokens_win_over_very_common_ones(mirror):
+    # Far more known descriptions share the city than a lookup scores
+    stores = [('TARGET T-' + str(store) + ' SAN JOSE CA', 'Shopping') for store in range(budget.CATEGORY_MAX_CANDIDATES * 2)]
+    mirror.category_index.update(stores + [('SHELL OIL SAN JOSE CA', 'Gas')])
+    assert mirror.category_index.lookup('SAN JOSE SHELL OIL CA') == ('Gas', 1.0, 'fuzzy')
@@ -0,0 +1,39 @@
+# Multiset dedup: each row already in the sheet cancels out one matching transaction
+
+from collections import Counter
+
+import pandas
+
+import budget
+
+def transactions(*rows):
+    # Debit transactions frame of (description, date serial, cents) rows
+    (descriptions, dates, cents) = zip(*rows)
+    return pandas.DataFrame({'Ledger': 'Debit', 'Description': list(descriptions), 'Date': list(dates), 'Cents': list(cents)}).astype(budget.TRANSACTION_DTYPES)
+
+def index(*rows):
+    # Fingerprint index of sheet rows (description, date serial, cents)
+    return Counter(budget.transaction_fingerprint([description, '', date_serial, cents / 100]) for (description, date_serial, cents) in rows)
+
+def test_repeated_transactions_survive_once_per_missing_row():
+    new = budget.remove_indexed_transactions(transactions(('COFFEE', 44256, -500), ('COFFEE', 44256, -500), ('COFFEE', 44256, -500)), index(('COFFEE', 44256, -500)))
+    assert len(new) == 2
+
+def test_same_description_on_another_day_or_amount_is_new():
+    new = budget.remove_indexed_transactions(transactions(('COFFEE', 44256, -500), ('COFFEE', 44257, -500), ('COFFEE', 44256, -450)), index(('COFFEE', 44256, -500)))
+    assert list(zip(new['Date'], new['Cents'])) == [(44257, -500), (44256, -450)]
+
+def test_descriptions_match_regardless_of_case_and_spacing():
+    new = budget.remove_indexed_transactions(transactions(('Coffee  Shop', 44256, -500),), index(('COFFEE SHOP ', 44256, -500)))
+    assert new.empty
+
+def test_remove_leaves_the_index_untouched():
+    sheet_index = index(('COFFEE', 44256, -500))
+    budget.remove_indexed_transactions(transactions(('COFFEE', 44256, -500),),sheet_index)
+    assert sum(sheet_index.values()) == 1
+
+def test_consume_uses_up_rows_across_chunks():
+    remaining = index(('COFFEE', 44256, -500))
+    first = budget.consume_indexed_transactions(transactions(('COFFEE', 44256, -500),),remaining)
+    second = budget.consume_indexed_transactions(transactions(('COFFEE', 44256, -500),),remaining)
+    assert (len(first), len(second)) == (0, 1)
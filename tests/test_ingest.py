@@ -0,0 +1,52 @@
+# Ingest: csv exports are split by year and only new transactions are added to each year's spreadsheet
+
+from datetime import date
+
+import pytest
+
+import budget
+
+@pytest.mark.parametrize('chunksize', [None, 1])
+def test_overlapping_exports_add_each_transaction_once(session,spreadsheet,mirror,manifest,statement,chunksize):
+    budget.ingest(session,mirror,manifest,input_files=[statement('a.csv', [(date(2021, 12, 30), 'GROCERY', -10.0), (date(2021, 12, 31), 'RENT', -20.0)])])
+
+    # Next export overlaps the previous one and spans new year, the same purchase made twice a day counts twice
+    new_statement = statement('b.csv', [(date(2021, 12, 31), 'RENT', -20.0), (date(2022, 1, 1), 'PHARMACY', -30.0), (date(2022, 1, 1), 'PHARMACY', -30.0)])
+    results = budget.ingest(session,mirror,manifest,input_files=[new_statement],chunksize=chunksize)
+
+    assert not any(result.errors for (name, spreadsheet_id, result) in results)
+    assert [row[0] for row in spreadsheet.workbooks['2021 Budget']['Debit'][1:]] == ['GROCERY', 'RENT']
+    assert [row[0] for row in spreadsheet.workbooks['2022 Budget']['Debit'][1:]] == ['PHARMACY', 'PHARMACY']
+
+@pytest.mark.parametrize('chunksize', [None, 1])
+def test_exports_overlapping_in_one_run_add_each_transaction_once(session,spreadsheet,mirror,manifest,statement,chunksize):
+    # Both exports list the same rent, the pharmacy purchase made twice a day is in one of them only
+    input_files = [
+        statement('feb.csv', [(date(2021, 2, 27), 'GROCERY', -10.0), (date(2021, 3, 2), 'RENT', -20.0)]),
+        statement('mar.csv', [(date(2021, 3, 2), 'RENT', -20.0), (date(2021, 3, 5), 'PHARMACY', -30.0), (date(2021, 3, 5), 'PHARMACY', -30.0)]),
+    ]
+    results = budget.ingest(session,mirror,manifest,input_files=input_files,chunksize=chunksize)
+
+    assert not any(result.errors for (name, spreadsheet_id, result) in results)
+    assert [row[0] for row in spreadsheet.workbooks['2021 Budget']['Debit'][1:]] == ['GROCERY', 'RENT', 'PHARMACY', 'PHARMACY']
+
+def test_statement_downloaded_twice_in_one_batch_is_read_once(session,spreadsheet,mirror,manifest,statement,tmp_path):
+    transactions = [(date(2021, 3, 1), 'GROCERY', -10.0), (date(2021, 3, 2), 'RENT', -20.0)]
+    statement('export.csv', transactions)
+    statement('export (1).csv', transactions)
+    input_files = budget.get_csv_files(manifest,str(tmp_path))
+    assert len(input_files) == 1
+
+    budget.ingest(session,mirror,manifest,input_files=input_files)
+    # Both copies are recorded as ingested
+    assert budget.get_csv_files(manifest,str(tmp_path)) == []
+    assert [row[0] for row in spreadsheet.workbooks['2021 Budget']['Debit'][1:]] == ['GROCERY', 'RENT']
+
+def test_invalidated_spreadsheet_id_leaves_similar_names_cached(session,mirror):
+    mirror.set_meta('spreadsheet_id:2021 Budget','old-id')
+    mirror.set_meta('spreadsheet_id:2021 Budget Copy','copy-id')
+
+    budget.SpreadsheetResolver(session,mirror).invalidate('2021 Budget')
+
+    assert mirror.get_meta('spreadsheet_id:2021 Budget') is None
+    assert mirror.get_meta('spreadsheet_id:2021 Budget Copy') == 'copy-id'
@@ -0,0 +1,20 @@
+# Merchant normalization: bulk normalize_descriptions runs every description through extract_useful_string
+
+import pandas
+
+import budget
+
+def test_merchant_names():
+    descriptions = ['STARBUCKS STORE 12345 SEATTLE WA', 'BIG 5 SPORTING GOODS 123', 'ZEL *JOHN SMITH 123456', 'PAYROLL DEPOSIT CO: ACME CORP', "TRADER JOE'S #552", 'NETFLIX.COM']
+    assert [budget.extract_useful_string(description) for description in descriptions] == ['STARBUCKS STORE', 'BIG 5 SPORTING GOODS', 'ZEL *JOHN SMITH', 'PAYROLL DEPOSIT', "TRADER JOE'S", 'NETFLIX.COM']
+
+def test_bulk_matches_single_description_and_uses_its_cache():
+    budget.extract_useful_string.cache_clear()
+    descriptions = pandas.Series(['UBER *TRIP 8005928996', 'SHELL OIL 57444', 'UBER *TRIP 8005928996', 'To Share 0012 transfer'], index=[3, 1, 2, 0])
+
+    normalized = budget.normalize_descriptions(descriptions)
+
+    assert normalized.tolist() == [budget.extract_useful_string(description) for description in descriptions]
+    assert list(normalized.index) == [3, 1, 2, 0]
+    # Each distinct description normalized once by the bulk call, then found in the cache
+    assert budget.extract_useful_string.cache_info().misses == 3
@@ -0,0 +1,113 @@
+# Offline outbox: updates queued while offline land in the sheet once replayed
+
+from datetime import date
+
+import budget
+from benchmarks.fake_sheets import FakeRequest, http_error
+
+def test_replay_appends_below_rows_added_by_hand(session,spreadsheet,mirror,manifest,statement):
+    budget.ingest(session,mirror,manifest,input_files=[statement('a.csv', [(date(2021, 3, 1), 'GROCERY', -10.0), (date(2021, 3, 2), 'RENT', -20.0)])])
+    budget.ingest(session,mirror,manifest,input_files=[statement('b.csv', [(date(2021, 3, 3), 'PHARMACY', -30.0)])],backend=budget.OutboxBackend(mirror))
+    # Row added to the sheet where the queued row was planned
+    debit = spreadsheet.workbooks['2021 Budget']['Debit']
+    debit.append(['HAND', '', debit[-1][2], -5.0, '', ''])
+    entries = mirror.outbox_entries()
+
+    budget.replay_outbox(session,mirror)
+    assert mirror.outbox_count() == 0
+    assert [row[0] for row in debit[1:]] == ['GROCERY', 'RENT', 'HAND', 'PHARMACY']
+    # Mirror no longer knows where the row landed
+    assert mirror.needs_sync('2021 Budget','Debit')
+
+    # Replaying the same update again (i.e. interrupted before it was removed) writes nothing twice
+    for (entry_id, spreadsheet_id, value_input_option, data, guards) in entries:
+        mirror.enqueue_outbox(spreadsheet_id,value_input_option,data,guards)
+    budget.replay_outbox(session,mirror)
+    assert [row[0] for row in debit[1:]] == ['GROCERY', 'RENT', 'HAND', 'PHARMACY']
+
+def test_update_failing_for_good_is_set_aside(session,spreadsheet,mirror,manifest,statement,tmp_path,capsys):
+    budget.ingest(session,mirror,manifest,input_files=[statement('a.csv', [(date(2021, 3, 1), 'GROCERY', -10.0)])])
+    backend = budget.OutboxBackend(mirror)
+    budget.ingest(session,mirror,manifest,input_files=[statement('b.csv', [(date(2021, 3, 2), 'RENT', -20.0)])],backend=backend)
+    budget.ingest(session,mirror,manifest,input_files=[statement('c.csv', [(date(2022, 1, 3), 'PHARMACY', -30.0)])],backend=backend)
+    # Spreadsheet deleted while its updates were queued
+    spreadsheet.deleted.add('2021 Budget')
+
+    budget.replay_outbox(session,mirror)
+
+    # Other spreadsheets are still updated, nothing is left blocking the outbox
+    assert [row[0] for row in spreadsheet.workbooks['2022 Budget']['Debit'][1:]] == ['PHARMACY']
+    assert mirror.outbox_count() == 0
+    assert {spreadsheet_id for (entry_id, spreadsheet_id, ranges, error, failed_at) in mirror.failed_outbox()} == {'2021 Budget'}
+    # Spreadsheet is looked up and read again on next run
+    assert mirror.get_meta('spreadsheet_id:2021 Budget') is None
+    assert mirror.needs_sync('2021 Budget','Debit')
+
+    capsys.readouterr()
+    budget.print_status(manifest,mirror,str(tmp_path))
+    assert '2021 Budget failed' in capsys.readouterr().out
+
+def test_ingest_never_waits_on_google_while_offline(session,spreadsheet,mirror,manifest,statement,monkeypatch):
+    budget.ingest(session,mirror,manifest,input_files=[statement('a.csv', [(date(2021, 3, 1), 'GROCERY', -10.0)])])
+    # Mirror consistency check due, next year's spreadsheet not looked up yet
+    mirror.expire_sync('2021 Budget','Debit')
+    mirror.delete_meta('spreadsheet_id:2022 Budget')
+    # Google unreachable
+    attempts = []
+    def refused(request,**kwargs):
+        attempts.append(request.methodId)
+        raise ConnectionRefusedError(111, 'Connection refused')
+    monkeypatch.setattr(FakeRequest, 'execute', refused)
+    monkeypatch.setattr(budget.time, 'sleep', lambda seconds: attempts.append('sleep'))
+
+    results = budget.ingest(session,mirror,manifest,input_files=[statement('b.csv', [(date(2021, 12, 31), 'RENT', -20.0), (date(2022, 1, 1), 'PHARMACY', -30.0)])],
+        backend=budget.OutboxBackend(mirror))
+
+    # One attempt, no backoff, every later call skipped
+    assert attempts == ['sheets.spreadsheets.values.get']
+    # Known year is queued against the mirror, the year that could not be looked up fails alone
+    assert [(name, spreadsheet_id, sorted(result.errors)) for (name, spreadsheet_id, result) in results] == [('2021 Budget', '2021 Budget', []), ('2022 Budget', None, ['Credit', 'Debit'])]
+    assert mirror.outbox_count('2021 Budget')
+    assert not budget.send_outbox(session,mirror)
+    assert mirror.outbox_count('2021 Budget')
+
+def test_replay_sends_queued_updates_once(session,spreadsheet,mirror,manifest,statement):
+    backend = budget.OutboxBackend(mirror)
+    budget.ingest(session,mirror,manifest,input_files=[statement('a.csv', [(date(2021, 3, 1), 'GROCERY', -10.0)])],backend=backend)
+    budget.ingest(session,mirror,manifest,input_files=[statement('b.csv', [(date(2021, 3, 2), 'RENT', -20.0)])],backend=backend)
+    entries = mirror.outbox_entries()
+
+    profiler = budget.RunProfiler()
+    assert budget.send_outbox(session,mirror,profiler)
+    # Time spent writing to google sheets is reported
+    assert profiler.stages['replay']['rows'] == len(entries)
+    debit = spreadsheet.workbooks['2021 Budget']['Debit']
+    assert [(row[0], row[4]) for row in debit[1:]] == [('GROCERY', -10.0), ('RENT', -30.0)]
+
+    # Same updates replayed again (i.e. interrupted before they were removed) land on the same rows
+    for (entry_id, spreadsheet_id, value_input_option, data, guards) in entries:
+        mirror.enqueue_outbox(spreadsheet_id,value_input_option,data,guards)
+    budget.replay_outbox(session,mirror)
+    assert [(row[0], row[4]) for row in debit[1:]] == [('GROCERY', -10.0), ('RENT', -30.0)]
+    assert not mirror.needs_sync('2021 Budget','Debit')
+
+def test_transient_failure_keeps_every_update_queued(session,spreadsheet,mirror,manifest,statement,monkeypatch):
+    budget.ingest(session,mirror,manifest,input_files=[statement('a.csv', [(date(2021, 3, 1), 'GROCERY', -10.0)])],backend=budget.OutboxBackend(mirror))
+    queued = mirror.outbox_count()
+    def unavailable(request,**kwargs):
+        raise http_error(503, 'The service is currently unavailable.')
+    monkeypatch.setattr(FakeRequest, 'execute', unavailable)
+    monkeypatch.setattr(budget.time, 'sleep', lambda seconds: None)
+
+    assert not budget.send_outbox(session,mirror)
+    assert mirror.outbox_count() == queued
+    assert not mirror.failed_outbox()
+
+def test_sync_waits_for_queued_updates(session,spreadsheet,mirror,manifest,statement):
+    budget.ingest(session,mirror,manifest,input_files=[statement('a.csv', [(date(2021, 3, 1), 'GROCERY', -10.0)])],backend=budget.OutboxBackend(mirror))
+    spreadsheet.calls.clear()
+
+    # Sheet is still empty, reading it now would drop the queued rows from the mirror
+    assert not budget.sync_ledger_mirror('Debit','2021 Budget',session,mirror,force=True)
+    assert not spreadsheet.calls
+    assert mirror.last_row('2021 Budget','Debit') == 2
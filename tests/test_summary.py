@@ -0,0 +1,30 @@
+# Summary sheet: monthly totals rewritten with every run's new rows, in the same request
+
+from datetime import date
+
+import budget
+
+def test_summary_goes_out_with_the_new_rows(session,spreadsheet,mirror,manifest,statement):
+    budget.ingest(session,mirror,manifest,input_files=[statement('a.csv', [(date(2021, 3, 1), 'GROCERY', -10.0), (date(2021, 4, 2), 'RENT', -20.0)])],
+        backend=budget.OutboxBackend(mirror))
+
+    # One update, written as plain values
+    [(entry_id, spreadsheet_id, value_input_option, data, guards)] = mirror.outbox_entries()
+    assert value_input_option == 'RAW'
+    assert sorted(value_range['range'] for value_range in data) == ['Debit!A2:F3', 'Summary!A1:F7']
+
+    # Summary sheet added when the update is sent
+    budget.replay_outbox(session,mirror)
+    summary = spreadsheet.workbooks['2021 Budget']['Summary']
+    assert summary[0] == budget.SUMMARY_HEADER
+    assert [row[:3] for row in summary[1:] if row[2] == 'Total'] == [['2021-03', 'Debit', 'Total'], ['2021-04', 'Debit', 'Total']]
+
+def test_summary_adds_to_stored_totals_without_extra_calls(session,spreadsheet,mirror,manifest,statement):
+    budget.ingest(session,mirror,manifest,input_files=[statement('a.csv', [(date(2021, 3, 1), 'GROCERY', -10.0)])])
+    spreadsheet.calls.clear()
+
+    budget.ingest(session,mirror,manifest,input_files=[statement('b.csv', [(date(2021, 3, 2), 'RENT', -20.0)])])
+
+    assert [method_id for (method_id, ranges) in spreadsheet.calls if method_id != 'sheets.spreadsheets.values.get'] == ['sheets.spreadsheets.values.batchUpdate']
+    totals = [row for row in spreadsheet.workbooks['2021 Budget']['Summary'] if row[2] == 'Total']
+    assert totals == [['2021-03', 'Debit', 'Total', '', -30.0, 2]]
@@ -0,0 +1,86 @@
+# Mirror sync: the local mirror follows the ledger sheets, so new rows land right after the sheet's last row
+
+from datetime import date
+
+import pytest
+
+import budget
+from benchmarks.fake_sheets import FakeRequest
+
+def test_rows_added_by_hand_are_not_overwritten(session,spreadsheet,mirror,manifest,statement):
+    budget.ingest(session,mirror,manifest,input_files=[statement('a.csv', [(date(2021, 3, 1), 'GROCERY', -10.0), (date(2021, 3, 2), 'RENT', -20.0)])])
+    # Row added to the sheet between runs, while the mirror is still fresh
+    debit = spreadsheet.workbooks['2021 Budget']['Debit']
+    debit.append(['HAND', '', debit[-1][2], -5.0, '', ''])
+
+    budget.ingest(session,mirror,manifest,input_files=[statement('b.csv', [(date(2021, 3, 3), 'PHARMACY', -30.0)])])
+
+    assert [row[0] for row in debit[1:]] == ['GROCERY', 'RENT', 'HAND', 'PHARMACY']
+    assert mirror.last_row('2021 Budget','Debit') == 5
+
+def ledger(spreadsheet,rows):
+    # Debit sheet of spreadsheet 'budget' holding rows (description, date serial, amount)
+    debit = spreadsheet.workbook('budget')['Debit']
+    debit.extend([description, '', date_serial, amount, '', ''] for (description, date_serial, amount) in rows)
+    return debit
+
+def reads(spreadsheet):
+    # Ranges read so far, then forget them
+    ranges = [ranges for (method_id, ranges) in spreadsheet.calls if method_id == 'sheets.spreadsheets.values.get']
+    spreadsheet.calls.clear()
+    return ranges
+
+def test_first_sync_mirrors_the_whole_ledger(session,spreadsheet,mirror):
+    ledger(spreadsheet, [('GROCERY', 44256, -10.0), ('GROCERY', 44256, -10.0), ('RENT', 44257, -20.0)])
+
+    assert budget.sync_ledger_mirror('Debit','budget',session,mirror)
+    assert reads(spreadsheet) == ['Debit!A2:F']
+    assert mirror.last_row('budget','Debit') == 4
+    assert mirror.fingerprint_index('budget','Debit')[('grocery', 44256, -1000)] == 2
+
+def test_fresh_mirror_only_checks_the_last_row(session,spreadsheet,mirror):
+    ledger(spreadsheet, [('GROCERY', 44256, -10.0), ('RENT', 44257, -20.0)])
+    budget.sync_ledger_mirror('Debit','budget',session,mirror)
+    reads(spreadsheet)
+
+    assert not budget.sync_ledger_mirror('Debit','budget',session,mirror,since=44257)
+    assert reads(spreadsheet) == ['Debit!A3:F']
+
+def test_due_sync_reads_from_the_row_above_the_window(session,spreadsheet,mirror):
+    debit = ledger(spreadsheet, [('GROCERY', 44256, -10.0), ('RENT', 44257, -20.0), ('PHARMACY', 44258, -30.0)])
+    budget.sync_ledger_mirror('Debit','budget',session,mirror)
+    # Amount edited by hand inside the window, consistency check due
+    debit[3][3] = -25.0
+    mirror.connection.execute('UPDATE sync SET synced_at = 0')
+    reads(spreadsheet)
+
+    assert budget.sync_ledger_mirror('Debit','budget',session,mirror,since=44258)
+    assert reads(spreadsheet) == ['Debit!A3:F']
+    assert ('pharmacy', 44258, -2500) in mirror.fingerprint_index('budget','Debit')
+
+def test_rows_moved_above_the_window_read_the_whole_ledger(session,spreadsheet,mirror):
+    debit = ledger(spreadsheet, [('GROCERY', 44256, -10.0), ('RENT', 44257, -20.0), ('PHARMACY', 44258, -30.0)])
+    budget.sync_ledger_mirror('Debit','budget',session,mirror)
+    # Row inserted by hand above the window shifts every row below it
+    debit.insert(1, ['HAND', '', 44250, -5.0, '', ''])
+    mirror.connection.execute('UPDATE sync SET synced_at = 0')
+    reads(spreadsheet)
+
+    assert budget.sync_ledger_mirror('Debit','budget',session,mirror,since=44258)
+    assert reads(spreadsheet) == ['Debit!A3:F', 'Debit!A2:F']
+    assert mirror.last_row('budget','Debit') == 5
+    assert mirror.row_fingerprint('budget','Debit',2) == budget.fingerprint_key(('hand', 44250, -500))
+
+def test_unreachable_google_falls_back_to_a_synced_mirror(session,spreadsheet,mirror,monkeypatch):
+    ledger(spreadsheet, [('GROCERY', 44256, -10.0)])
+    budget.sync_ledger_mirror('Debit','budget',session,mirror)
+    mirror.connection.execute('UPDATE sync SET synced_at = 0')
+    def refused(request,**kwargs):
+        raise ConnectionRefusedError(111, 'Connection refused')
+    monkeypatch.setattr(FakeRequest, 'execute', refused)
+
+    with session.scheduler.failing_fast():
+        assert not budget.sync_ledger_mirror('Debit','budget',session,mirror)
+        # Never synced ledger has nothing to fall back to
+        with pytest.raises(OSError):
+            budget.sync_ledger_mirror('Credit','budget',session,mirror)
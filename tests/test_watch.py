@@ -0,0 +1,32 @@
+# Watch mode: batches of downloaded csv files are ingested once they settle, old csv files are cleaned meanwhile
+
+import os
+import time
+
+import budget
+
+class QuietWatcher:
+    # Watcher of a folder where nothing is downloaded, stops watch mode after a few waits
+    def __init__(self,waits):
+        self.waits = waits
+
+    def wait(self,timeout):
+        self.waits -= 1
+        if self.waits < 0:
+            raise KeyboardInterrupt
+        return set()
+
+    def close(self):
+        pass
+
+def test_old_csv_files_are_cleaned_while_nothing_is_downloaded(session,mirror,manifest,tmp_path,monkeypatch):
+    old = tmp_path / 'old.csv'
+    old.write_text('')
+    old_time = time.time() - budget.CSV_MAX_AGE - 60
+    os.utime(old, (old_time, old_time))
+    monkeypatch.setattr(budget, 'open_watcher', lambda directory: QuietWatcher(2))
+    monkeypatch.setattr(budget, 'WATCH_CLEAN_INTERVAL', 0)
+
+    budget.watch(session,mirror,manifest,str(tmp_path),debounce=3600)
+
+    assert not old.exists()